@@ -16,6 +16,28 @@ import importlib
 import configparser
 import contextlib
 import multiprocessing
+import argparse
+import subprocess
+import threading
+import socket
+import signal
+import atexit
+import json
+import queue
+import codecs
+import hashlib
+import pickle
+import marshal
+import itertools
+import math
+import statistics
+import warnings
+import xml.sax.saxutils
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
 
 RUN_INSTRUCTIONS = """
 
@@ -37,6 +59,21 @@ GRADER_VERSION = 5
 PYTHON_VERSION_MAJOR = 3
 PYTHON_VERSION_MINOR = 9
 ERROR_LOG = "error.log"
+BATCH_RESULTS = "batch-results.json"
+DEFAULT_JOBS = os.cpu_count() or 1
+DIFF_WINDOW = 64 * 1024
+DIFF_MAX_LINES = 5000  # bigger outputs only get a summary of their differences
+DIFF_MAX_EDITS = 1000
+DIFF_SUMMARY_LINES = 50
+CACHE_DIR = ".grader-cache"
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+HISTORY_FILE = "history.json"  # kept in CACHE_DIR
+ORDERS = ("history", "fixed")
+DEFAULT_ORDER = ORDERS[0]
+GUI_BATCH_INTERVAL = 0.1  # seconds between result batches sent to the GUI
+GUI_REFRESH = 100  # milliseconds between reads of those batches
+GUI_PAGE_LINES = 500  # output lines added to the viewer at a time
+WATCH_INTERVAL = 0.2  # seconds between checks for changed sources
 
 IGNORED_STYLE_ERRORS = ["W", "E115", "E116", "E117", "E12", "E26", "E3"]
 
@@ -60,9 +97,318 @@ class GraderException(Exception):
     pass
 
 
+class GraderOptions:
+    def __init__(
+        self,
+        jobs=None,
+        runner=None,
+        stop_on_mismatch=False,
+        max_failures=None,
+        cache=True,
+        order=None,
+    ):
+        self.jobs = jobs or DEFAULT_JOBS
+        self.runner = runner or DEFAULT_RUNNER
+        self.stop_on_mismatch = stop_on_mismatch
+        self.max_failures = max_failures
+        self.cache = cache
+        self.order = order or DEFAULT_ORDER
+
+
+class PhaseTimer:
+    # time spent in each phase of grading, for `grader.py bench`. nothing is
+    # recorded unless a timer is active. phases of tests that run side by side
+    # add up, so together they can exceed the wall time.
+    PHASES = ("zip", "style", "workspace", "spawn", "run", "compare", "feedback")
+    active = None
+
+    def __init__(self):
+        self.totals = dict.fromkeys(PhaseTimer.PHASES, 0.0)
+
+    @classmethod
+    def record(cls, phase, seconds):
+        if cls.active is not None:
+            cls.active.totals[phase] += seconds
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(phase, time.perf_counter() - start)
+
+
+def _diff_opcodes(a, b, max_edits=DIFF_MAX_EDITS):
+    # myers' O((N+M)D) diff over lines, as SequenceMatcher-style opcodes.
+    # returns None when the sequences need more than `max_edits` edits.
+    lo = 0
+    while lo < len(a) and lo < len(b) and a[lo] == b[lo]:
+        lo += 1
+    hi_a, hi_b = len(a), len(b)
+    while hi_a > lo and hi_b > lo and a[hi_a - 1] == b[hi_b - 1]:
+        hi_a, hi_b = hi_a - 1, hi_b - 1
+
+    n, m = hi_a - lo, hi_b - lo
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(min(n + m, max_edits) + 1):
+        trace.append(v[offset - d - 1 : offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[lo + x] == b[lo + y]:
+                x, y = x + 1, y + 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+
+    # walk back through the saved frontiers to find the edits
+    edits = []  # (tag, i, j) in reverse
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d]  # frontier before step d, indexed from k = -d - 1
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d + 1] < prev[k + 1 + d + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = prev[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            edits.append(("equal", x, y))
+        if x == prev_x:
+            edits.append(("insert", x, y - 1))
+        else:
+            edits.append(("delete", x - 1, y))
+        x, y = prev_x, prev_y
+    while x > 0 and y > 0:
+        x, y = x - 1, y - 1
+        edits.append(("equal", x, y))
+
+    opcodes = []
+    if lo:
+        opcodes.append(["equal", 0, lo, 0, lo])
+    for tag, i, j in reversed(edits):
+        i, j = i + lo, j + lo
+        i2 = i + (tag != "insert")
+        j2 = j + (tag != "delete")
+        last = opcodes[-1] if opcodes else None
+        if last and last[0] == "equal" and tag == "equal":
+            last[2], last[4] = i2, j2
+        elif last and last[0] != "equal" and tag != "equal":
+            last[0] = "replace" if last[0] != tag else tag
+            last[2], last[4] = i2, j2
+        else:
+            opcodes.append([tag, i, i2, j, j2])
+    if hi_a < len(a):
+        opcodes.append(["equal", hi_a, len(a), hi_b, len(b)])
+    return opcodes
+
+
+def _diff_hints(aline, bline):
+    # the "? " lines difflib.Differ writes under a changed line
+    atags = btags = ""
+    cruncher = difflib.SequenceMatcher(None, aline, bline)
+    for tag, ai1, ai2, bj1, bj2 in cruncher.get_opcodes():
+        la, lb = ai2 - ai1, bj2 - bj1
+        if tag == "replace":
+            atags += "^" * la
+            btags += "^" * lb
+        elif tag == "delete":
+            atags += "-" * la
+        elif tag == "insert":
+            btags += "+" * lb
+        else:
+            atags += " " * la
+            btags += " " * lb
+
+    def keep_ws(line, tags):
+        # tabs in the line stay tabs, so the markers line up
+        return "".join(
+            c if t == " " and c.isspace() else t for c, t in zip(line, tags)
+        ).rstrip()
+
+    return keep_ws(aline, atags), keep_ws(bline, btags)
+
+
+def _diff_replace(a, b):
+    # changed lines are paired up in order; similar pairs get hints
+    for aline, bline in zip(a, b):
+        cruncher = difflib.SequenceMatcher(None, aline, bline)
+        if (
+            cruncher.real_quick_ratio() > 0.75
+            and cruncher.quick_ratio() > 0.75
+            and cruncher.ratio() > 0.75
+        ):
+            atags, btags = _diff_hints(aline, bline)
+            yield "- " + aline
+            if atags:
+                yield "? {:s}\n".format(atags)
+            yield "+ " + bline
+            if btags:
+                yield "? {:s}\n".format(btags)
+        else:
+            yield "- " + aline
+            yield "+ " + bline
+    for aline in a[len(b) :]:
+        yield "- " + aline
+    for bline in b[len(a) :]:
+        yield "+ " + bline
+
+
+def diff_lines(expect, actual):
+    # same line prefixes as difflib.Differ ("  ", "- ", "+ ", "? "), without
+    # its quadratic search for the most similar lines
+    if expect == actual:
+        yield from ("  " + x for x in expect)
+        return
+
+    opcodes = None
+    if max(len(expect), len(actual)) <= DIFF_MAX_LINES:
+        opcodes = _diff_opcodes(expect, actual)
+    if opcodes is None:
+        yield from _diff_summary(expect, actual)
+        return
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            yield from ("  " + x for x in expect[i1:i2])
+        elif tag == "delete":
+            yield from ("- " + x for x in expect[i1:i2])
+        elif tag == "insert":
+            yield from ("+ " + x for x in actual[j1:j2])
+        else:
+            yield from _diff_replace(expect[i1:i2], actual[j1:j2])
+
+
+def _diff_summary(expect, actual, limit=DIFF_SUMMARY_LINES):
+    yield "  (outputs differ too much to compare in full, showing the first {:d} differing lines)".format(
+        limit
+    )
+    shown = 0
+    for number, (aline, bline) in enumerate(
+        itertools.zip_longest(expect, actual), start=1
+    ):
+        if aline == bline:
+            continue
+        if shown == limit:
+            break
+        shown += 1
+        yield "  (line {:d})".format(number)
+        if aline is not None:
+            yield "- " + aline
+        if bline is not None:
+            yield "+ " + bline
+
+
+class LazyDiff:
+    # diffs are worked out when the output is read, not when tests run
+
+    def __init__(self, actual, expect):
+        self.actual = actual
+        self.expect = expect
+
+    def __iter__(self):
+        return diff_lines(self.expect.splitlines(), self.actual.splitlines())
+
+
+class OutputSpool:
+    # result output is appended to a file and read back when it is needed, so
+    # large runs don't keep every diff and input dump in memory. a pickled
+    # spool (e.g. a result sent to the GUI process) is reopened by its path.
+    default = None
+    spools = {}
+    lock = threading.Lock()
+    default_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.owned = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="grader-", suffix=".spool")
+            os.close(fd)
+            atexit.register(self.close)
+        self.path = path
+        self.file = None
+        self.file_lock = threading.Lock()
+        with OutputSpool.lock:
+            OutputSpool.spools[path] = self
+
+    def __reduce__(self):
+        return (OutputSpool.open, (self.path,))
+
+    @classmethod
+    def open(cls, path):
+        with cls.lock:
+            spool = cls.spools.get(path)
+        return spool or cls(path)
+
+    @classmethod
+    def get_default(cls):
+        with cls.default_lock:
+            if cls.default is None:
+                cls.default = cls()
+        return cls.default
+
+    def write(self, entries):
+        data = pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.file_lock:
+            if self.file is None:
+                self.file = open(self.path, "a+b")
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(data)
+            self.file.flush()
+        return offset, len(data)
+
+    def read(self, offset, length):
+        with self.file_lock:
+            if self.file is None:
+                self.file = open(self.path, "a+b")
+            self.file.seek(offset)
+            data = self.file.read(length)
+        return pickle.loads(data)
+
+    def close(self):
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.owned:
+                with contextlib.suppress(OSError):
+                    os.remove(self.path)
+
+
 class GraderTestResult:
     HEADER_TAG = chr(0x06) * 2
     ERROR_ID = "error"
+    __slots__ = (
+        "report",
+        "id",
+        "index",
+        "score",
+        "info",
+        "runtime",
+        "timeout",
+        "soft_timeout",
+        "exit_code",
+        "cpu_time",
+        "max_rss",
+        "skipped",
+        "output",
+        "spooled",
+    )
 
     def __init__(self, id, passed=True, runtime=None):
         self.report = None
@@ -72,7 +418,14 @@ class GraderTestResult:
         self.score = 1.0 if passed else 0.0
         self.info = None
         self.runtime = runtime
-        self.output = []
+        self.timeout = None  # per-test limits, when they differ from the report's
+        self.soft_timeout = None
+        self.exit_code = None
+        self.cpu_time = None
+        self.max_rss = None
+        self.skipped = False
+        self.output = []  # lines, and diffs that haven't been worked out yet
+        self.spooled = None  # (spool, offset, length) once output is stored
 
     def get_name(self):
         src = self.report.source if self.report else "<unknown>"
@@ -85,6 +438,7 @@ class GraderTestResult:
         )
 
     def attach_output(self, label, data=None, prefix="  "):
+        self._unspool()
         self.output.append(
             "{htag:s}<{tag:s}>".format(htag=GraderTestResult.HEADER_TAG, tag=label)
         )
@@ -98,25 +452,107 @@ class GraderTestResult:
 
     def add_diff(self, label, actual, expect):
         self.attach_output(label)
-        self.output += list(
-            difflib.Differ(charjunk=lambda _: False).compare(
-                expect.splitlines(), actual.splitlines()
-            )
-        )
+        self.output.append(LazyDiff(actual, expect))
         self.output.append("  ")
 
+    def spool_output(self, spool):
+        if self.spooled is None and self.output:
+            offset, length = spool.write(self._pack(self.output))
+            self.spooled = (spool, offset, length)
+            self.output = None
+
+    def _unspool(self):
+        if self.spooled is not None:
+            self.output = self._get_entries()
+            self.spooled = None
+
+    def _get_entries(self):
+        if self.spooled is None:
+            return self.output
+        spool, offset, length = self.spooled
+        return self._unpack(spool.read(offset, length))
+
+    @staticmethod
+    def _pack(entries):
+        # unexpanded diffs are kept as {"actual": ..., "expect": ...}
+        return [x if isinstance(x, str) else vars(x) for x in entries]
+
+    @staticmethod
+    def _unpack(entries):
+        return [x if isinstance(x, str) else LazyDiff(**x) for x in entries]
+
     def get_output(self):
-        yield from self.output
+        for x in self._get_entries():
+            if isinstance(x, LazyDiff):
+                yield from x
+            else:
+                yield x
+
+    def to_dict(self, expand=True):
+        output = self.get_output() if expand else self._get_entries()
+        return {
+            "id": self.id,
+            "score": self.score,
+            "info": self.info,
+            "runtime": self.runtime,
+            "exit_code": self.exit_code,
+            "cpu_time": self.cpu_time,
+            "max_rss": self.max_rss,
+            "skipped": self.skipped,
+            "output": self._pack(output),
+        }
+
+    def update(self, data):
+        self.set_score(score=data["score"], info=data["info"])
+        self.runtime = data["runtime"]
+        self.exit_code = data.get("exit_code")
+        self.cpu_time = data.get("cpu_time")
+        self.max_rss = data.get("max_rss")
+        self.skipped = data["skipped"]
+        self.output = self._unpack(data["output"])
+        self.spooled = None
 
     def set_score(self, score=0.0, info=None):
         self.score = score
         self.info = info
 
+    def skip(self, info="not run (too many failed tests)"):
+        self.skipped = True
+        self.runtime = 0.0
+        self.set_score(score=0.0, info=info)
+
     def is_passing(self):
-        return self.score == 1.0 and self.runtime <= self.report.timeout
+        return self.score == 1.0 and self.runtime <= self.get_timeout()
+
+    def get_timeout(self):
+        return self.report.timeout if self.timeout is None else self.timeout
+
+    def get_soft_timeout(self):
+        if self.soft_timeout is None:
+            return self.report.soft_timeout
+        return self.soft_timeout
+
+    def detach(self, report):
+        # a copy that points to its spooled output instead of carrying it, and
+        # to a report without the other results
+        result = GraderTestResult(self.id)
+        for name in GraderTestResult.__slots__:
+            setattr(result, name, getattr(self, name))
+        result.report = report
+        return result
 
 
 class GraderReport:
+    __slots__ = (
+        "source",
+        "style_errors",
+        "timeout",
+        "soft_timeout",
+        "tests",
+        "results",
+        "errors",
+    )
+
     def __init__(self, source, tests=0, error=None):
         self.source = source
         self.style_errors = []
@@ -138,6 +574,7 @@ class GraderReport:
 
     def add_result(self, result):
         result.index = len(self.results)
+        result.spool_output(OutputSpool.get_default())
         self.results.append(result)
 
     def make_error(self):
@@ -149,14 +586,30 @@ class GraderReport:
         return sum(1 if x.is_passing() else 0 for x in self.results)
 
     def count_timeouts(self):
-        return sum(1 if x.runtime >= self.timeout else 0 for x in self.results)
+        return sum(1 if x.runtime >= x.get_timeout() else 0 for x in self.results)
 
     def count_soft_timeouts(self):
-        return sum(1 if x.runtime >= self.soft_timeout else 0 for x in self.results)
+        return sum(1 if x.runtime >= x.get_soft_timeout() else 0 for x in self.results)
+
+    def count_skipped(self):
+        return sum(1 if x.skipped else 0 for x in self.results)
 
     def has_errors(self):
         return self.errors or self.style_errors
 
+    def get_runtime_stats(self):
+        runtimes = sorted(
+            x.runtime for x in self.results if x.runtime is not None and not x.skipped
+        )
+
+        def percentile(p):
+            # nearest rank
+            if not runtimes:
+                return None
+            return runtimes[max(0, math.ceil(p / 100 * len(runtimes)) - 1)]
+
+        return {"p50": percentile(50), "p95": percentile(95), "max": percentile(100)}
+
     def get_grade(self, scale=1.0):
         if not self.tests:
             return 0.0
@@ -168,6 +621,602 @@ class GraderReport:
     def is_complete(self):
         return self.tests is None or len(self.results) == self.tests
 
+    def detach(self):
+        report = GraderReport(self.source, tests=self.tests)
+        report.style_errors = list(self.style_errors)
+        report.timeout = self.timeout
+        report.soft_timeout = self.soft_timeout
+        report.errors = set(self.errors)
+        return report
+
+
+def make_text_stream(x, config):
+    # for really specific file encoding issues
+    encoding_flags = dict()
+    enc = config.get("grader-config", "encoding", fallback=None)
+    if enc:
+        encoding_flags["encoding"] = enc
+        encoding_flags["errors"] = "ignore"
+    return (
+        x if isinstance(x, io.TextIOWrapper) else io.TextIOWrapper(x, **encoding_flags)
+    )
+
+
+class TestCase:
+    def __init__(self, id, config):
+        self.id = id
+        self.config = config
+        self.name = config.get("test-config", "test-name", fallback="#" + id)
+        self.stdin = None  # zip member names, relative to the test folder
+        self.stdout = None
+        self.inputs = []  # (file name in the workspace, member)
+        self.outputs = []
+
+
+class TestSuite:
+    # a test folder is listed once and split into a manifest per test case.
+    # input files are extracted to a staging folder the first time a case
+    # needs them, once for each distinct content, and every case gets its
+    # own copy. a suite whose programs only ever read their inputs can set
+    # `link-inputs = true` in [grader-config] to have the staged files, kept
+    # read-only, hard-linked into the workspaces instead, where the platform
+    # allows. read-only doesn't stop root from writing through a link.
+    LINK_SUPPORTED = os.name == "posix"
+
+    def __init__(self, folder, config):
+        self.folder = folder
+        self.config = config
+        self.staging = None
+        self.keys = {}  # (member, encoding) -> content key
+        self.staged = {}  # content key -> (path, (size, mtime))
+
+        names = [x.name for x in folder.iterdir()]
+        members = set(names)
+        cases = {}
+        for name in names:
+            if not name.endswith(".stdin"):
+                continue
+            test_id = name.split(".")[0]
+
+            # custom config file per-test supported
+            test_config = configparser.ConfigParser()
+            test_config.read_dict(config)
+            config_name = "{id:s}-config.ini".format(id=test_id)
+            if config_name in members:
+                config_file = folder / config_name
+                test_config.read_string(
+                    config_file.read_text(), source=str(config_file)
+                )
+
+            case = cases[test_id] = TestCase(test_id, test_config)
+            case.stdin = name
+            stdout_name = "{id:s}.stdout".format(id=test_id)
+            if stdout_name in members:
+                case.stdout = stdout_name
+
+        for name in sorted(names):
+            for tag, attr in (("-inp-", "inputs"), ("-out-", "outputs")):
+                test_id, sep, base = name.partition(tag)
+                if sep and test_id in cases:
+                    getattr(cases[test_id], attr).append((base, name))
+
+        self.cases = list(cases.values())
+
+    def get_key(self, member, config):
+        # staged files are decoded text, so the encoding is part of the content
+        encoding = config.get("grader-config", "encoding", fallback="")
+        key = self.keys.get((member, encoding))
+        if key is None:
+            key = self.keys[(member, encoding)] = "{content:s}-{enc:s}".format(
+                content=_content_key(self.folder / member),
+                enc=re.sub(r"\W", "_", encoding),
+            )
+        return key
+
+    def stage(self, member, config):
+        key = self.get_key(member, config)
+        path, stamp = self.staged.get(key, (None, None))
+        if path is not None:
+            # read-only doesn't stop everyone (root), so check nothing was
+            # written through a link before handing the file out again
+            info = os.stat(path)
+            if (info.st_size, info.st_mtime_ns) == stamp:
+                return path
+            os.unlink(path)
+
+        if self.staging is None:
+            self.staging = tempfile.mkdtemp()
+        path = os.path.join(self.staging, key)
+        with open(path, "w") as staged:
+            with (self.folder / member).open("r") as inpfd:
+                shutil.copyfileobj(make_text_stream(inpfd, config), staged)
+        if TestSuite.LINK_SUPPORTED:
+            os.chmod(path, 0o444)
+        info = os.stat(path)
+        self.staged[key] = (path, (info.st_size, info.st_mtime_ns))
+        return path
+
+    def place(self, member, config, dest, link=True):
+        path = self.stage(member, config)
+        link = link and config.getboolean(
+            "grader-config", "link-inputs", fallback=False
+        )
+        if link and TestSuite.LINK_SUPPORTED:
+            with contextlib.suppress(OSError):
+                os.link(path, dest)
+                return
+        shutil.copyfile(path, dest)
+
+    def close(self):
+        if self.staging is not None:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            self.staging = None
+            self.staged.clear()
+
+
+def _cpu_benchmark(rounds=5):
+    # a fixed amount of plain python work, best of a few rounds
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        total = 0
+        for i in range(500_000):
+            total += i * i % 7
+        sorted(str(i) for i in range(20_000))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Calibration:
+    # runtimes of a reference solution for every test, measured together
+    # with a cpu benchmark. on the grading machine the same benchmark gives
+    # a speed factor that timeouts are scaled by; a test that the reference
+    # needs a good share of the timeout for gets a proportionally longer one.
+    SLACK = 5  # reference runtime multiple that a timeout should allow for
+    FACTOR_RANGE = (0.25, 4.0)
+    DEAD_BAND = 0.1  # speed differences this small are noise, not scaled for
+    machine_speed = None  # benchmark on this machine, measured once
+
+    def __init__(self, benchmark, baselines=None, digest=None):
+        self.benchmark = benchmark
+        self.baselines = baselines or {}  # source -> test name -> runtime
+        self.digest = digest
+        self.factor = None
+
+    @staticmethod
+    def get_path(zippath):
+        return os.path.splitext(os.path.abspath(zippath))[0] + ".calibration.json"
+
+    @staticmethod
+    def get_digest(zippath):
+        with open(zippath, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def load(cls, zippath):
+        # the machine is benchmarked here, before grading puts any load on it
+        try:
+            with open(cls.get_path(zippath), "r") as f:
+                data = json.load(f)
+            if data["digest"] != cls.get_digest(zippath):
+                return None  # made for another version of the tests
+            calibration = cls(data["benchmark"], data["baselines"], data["digest"])
+        except (OSError, ValueError, KeyError):
+            return None
+        calibration.get_factor()
+        return calibration
+
+    def save(self, zippath):
+        path = self.get_path(zippath)
+        data = {
+            "digest": self.digest,
+            "benchmark": self.benchmark,
+            "baselines": self.baselines,
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        return path
+
+    def get_factor(self):
+        if self.factor is None:
+            if Calibration.machine_speed is None:
+                Calibration.machine_speed = _cpu_benchmark()
+            low, high = Calibration.FACTOR_RANGE
+            factor = Calibration.machine_speed / self.benchmark
+            if abs(factor - 1.0) <= Calibration.DEAD_BAND:
+                factor = 1.0
+            self.factor = min(high, max(low, factor))
+        return self.factor
+
+    def get_limits(self, source, test, timeout, soft_timeout):
+        scale = self.get_factor()
+        baseline = self.baselines.get(source, {}).get(test)
+        if baseline:
+            scale *= max(1.0, baseline * Calibration.SLACK / timeout)
+        return timeout * scale, soft_timeout * scale
+
+
+class WorkspacePool:
+    # test case folders are reused instead of being created and removed for
+    # every case. a workspace holds only the program source between cases;
+    # anything else a case leaves behind is deleted on release, and the
+    # source is written again if the program changed it.
+
+    def __init__(self, root, source, srcpath):
+        self.root = root
+        self.source = source
+        self.srcpath = srcpath
+        self.idle = []
+        self.ready = {}  # workspace -> (size, mtime) of the copied source
+
+    def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+        return tempfile.mkdtemp(dir=self.root)
+
+    def prepare(self, workspace):
+        if workspace in self.ready:
+            return
+        path = os.path.join(workspace, self.source)
+        with open(path, "w") as wsrc:
+            # open a local file version
+            with open(self.srcpath, "r") as source_file:
+                shutil.copyfileobj(source_file, wsrc)
+        info = os.stat(path)
+        self.ready[workspace] = (info.st_size, info.st_mtime_ns)
+
+    def release(self, workspace):
+        try:
+            self.reset(workspace)
+        except OSError:
+            # whatever is left over can't be trusted, so start again
+            self.ready.pop(workspace, None)
+            shutil.rmtree(workspace, ignore_errors=True)
+        else:
+            self.idle.append(workspace)
+
+    def reset(self, workspace):
+        stamp = self.ready.get(workspace)
+        for entry in os.scandir(workspace):
+            if entry.name == self.source and entry.is_file(follow_symlinks=False):
+                info = entry.stat(follow_symlinks=False)
+                if (info.st_size, info.st_mtime_ns) == stamp:
+                    continue
+                self.ready.pop(workspace, None)
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+        # make sure nothing from this case leaks into the next one
+        expected = [self.source] if workspace in self.ready else []
+        if os.listdir(workspace) != expected:
+            raise OSError("workspace not clean: " + workspace)
+
+
+class ResultWriter:
+    # machine readable results, written while grading runs. every test gets a
+    # JSON line as soon as it finishes, followed by a summary line once its
+    # report is complete; JUnit test suites are written per complete report.
+    XML_INVALID = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+    def __init__(self, jsonl=None, junit=None):
+        self.jsonl = open(jsonl, "w") if jsonl else None
+        self.junit = open(junit, "w", encoding="utf-8") if junit else None
+        if self.junit:
+            self.junit.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+        if self.junit:
+            self.junit.write("</testsuites>\n")
+            self.junit.close()
+            self.junit = None
+
+    def add(self, result, suite=None):
+        report = result.report
+        suite = suite or report.source
+        if self.jsonl:
+            self._write_line(
+                {
+                    "type": "test",
+                    "suite": suite,
+                    "id": result.id,
+                    "score": result.score,
+                    "passed": result.is_passing(),
+                    "skipped": result.skipped,
+                    "runtime": result.runtime,
+                    "timeout": self._over(result.runtime, result.get_timeout()),
+                    "soft_timeout": self._over(
+                        result.runtime, result.get_soft_timeout()
+                    ),
+                    "exit_code": result.exit_code,
+                    "cpu_time": result.cpu_time,
+                    "max_rss": result.max_rss,
+                    "info": result.info,
+                }
+            )
+        # the report may already be further along than this result, so the
+        # last result is what completes it
+        if report.tests is None or result.index + 1 >= report.tests:
+            if self.jsonl:
+                self._write_line(
+                    {
+                        "type": "report",
+                        "suite": suite,
+                        "grade": report.get_grade(),
+                        "tests": report.tests,
+                        "passed": report.count_passed(),
+                        "skipped": report.count_skipped(),
+                        "timeouts": report.count_timeouts(),
+                        "soft_timeouts": report.count_soft_timeouts(),
+                        "runtime": report.get_runtime_stats(),
+                        "errors": sorted(report.errors),
+                        "style_errors": len(report.style_errors),
+                    }
+                )
+            if self.junit:
+                self._write_suite(report, suite)
+
+    @staticmethod
+    def _over(runtime, limit):
+        return runtime is not None and runtime >= limit
+
+    def _write_line(self, data):
+        self.jsonl.write(json.dumps(data) + "\n")
+        self.jsonl.flush()
+
+    def _text(self, text):
+        return ResultWriter.XML_INVALID.sub("", text)
+
+    def _write_suite(self, report, suite):
+        quote = xml.sax.saxutils.quoteattr
+        results = report.results
+        failures = sum(1 for x in results if not x.skipped and not x.is_passing())
+        lines = [
+            '  <testsuite name={name:s} tests="{tests:d}" failures="{failures:d}" '
+            'errors="{errors:d}" skipped="{skipped:d}" time={time:s}>'.format(
+                name=quote(suite),
+                tests=len(results),
+                failures=failures,
+                errors=1 if report.errors else 0,
+                skipped=report.count_skipped(),
+                time=quote("{:.3f}".format(sum(x.runtime or 0.0 for x in results))),
+            ),
+            "    <properties>",
+        ]
+        stats = report.get_runtime_stats()
+        properties = [("runtime-" + k, stats[k]) for k in ("p50", "p95", "max")]
+        properties += [
+            ("timeouts", report.count_timeouts()),
+            ("soft-timeouts", report.count_soft_timeouts()),
+        ]
+        for name, value in properties:
+            lines.append(
+                "      <property name={:s} value={:s}/>".format(
+                    quote(name), quote(str(value))
+                )
+            )
+        lines.append("    </properties>")
+
+        for result in results:
+            lines.append(
+                "    <testcase classname={cls:s} name={name:s} time={time:s}>".format(
+                    cls=quote(suite),
+                    name=quote(str(result.id)),
+                    time=quote("{:.3f}".format(result.runtime or 0.0)),
+                )
+            )
+            if result.cpu_time is not None:
+                properties = '<property name="cpu-time" value={:s}/>'.format(
+                    quote("{:.3f}".format(result.cpu_time))
+                )
+                if result.max_rss is not None:
+                    properties += '<property name="max-rss" value="{:d}"/>'.format(
+                        result.max_rss
+                    )
+                lines.append("      <properties>{:s}</properties>".format(properties))
+            if result.skipped:
+                lines.append(
+                    "      <skipped message={:s}/>".format(quote(result.info or ""))
+                )
+            elif not result.is_passing():
+                output = "\n".join(
+                    x.replace(GraderTestResult.HEADER_TAG, "")
+                    for x in result.get_output()
+                )
+                lines.append(
+                    "      <failure message={:s}>{:s}</failure>".format(
+                        quote(self._text(result.info or "failed")),
+                        xml.sax.saxutils.escape(self._text(output)),
+                    )
+                )
+            lines.append("    </testcase>")
+
+        if report.errors:
+            lines.append(
+                "    <system-err>{:s}</system-err>".format(
+                    xml.sax.saxutils.escape(
+                        self._text("\n".join(sorted(report.errors)))
+                    )
+                )
+            )
+        lines.append("  </testsuite>")
+        self.junit.write("\n".join(lines) + "\n")
+        self.junit.flush()
+
+
+class ResultCache:
+    # finished test suites are stored under a hash of everything that can
+    # change their results: the program source, the test folder, the grader
+    # and python versions and the options that change how tests run. the
+    # least recently used entries are dropped once the cache grows too big.
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def make_key(self, folder, srcpath, *settings):
+        digest = hashlib.sha256()
+        for part in (GRADER_VERSION, sys.version) + settings:
+            digest.update(repr(part).encode("utf-8") + b"\0")
+        with open(srcpath, "rb") as f:
+            digest.update(f.read())
+
+        if isinstance(folder, zipfile.Path):
+            files = [
+                (info.filename, zipfile.Path(folder.root, info.filename))
+                for info in sorted(folder.root.infolist(), key=lambda x: x.filename)
+                if info.filename.startswith(folder.at) and not info.is_dir()
+            ]
+        else:
+            files = [
+                (file.relative_to(folder).as_posix(), file)
+                for file in sorted(pathlib.Path(folder).rglob("*"))
+                if file.is_file()
+            ]
+        for name, file in files:
+            digest.update(
+                "{name:s}:{content:s}\0".format(
+                    name=name, content=_content_key(file)
+                ).encode("utf-8")
+            )
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def get(self, key):
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                data = pickle.load(f)
+            os.utime(entry)  # mark as recently used
+        except Exception:
+            return None
+        return data
+
+    def put(self, key, data):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            entry = self._entry(key)
+            with open(entry + ".tmp", "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(entry + ".tmp", entry)
+            self.evict()
+        except OSError:
+            pass  # the cache is only an optimization
+
+    def load(self, key, report):
+        data = self.get(key)
+        if data is None:
+            return None
+
+        report.tests = data["tests"]
+        report.errors.update(data["errors"])
+        results = []
+        for item in data["results"]:
+            result = report.make_result(item["id"])
+            result.update(item)
+            results.append(result)
+        return results
+
+    def store(self, key, report):
+        # timeouts depend on how busy the machine was, so they aren't kept,
+        # and which tests get skipped depends on the order they ran in, which
+        # the history can change between runs
+        if not report.is_complete() or report.count_timeouts() > 0:
+            return
+        if report.count_skipped() > 0:
+            return
+        data = {
+            "tests": report.tests,
+            "errors": sorted(report.errors),
+            "results": [x.to_dict(expand=False) for x in report.results],
+        }
+        self.put(key, data)
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+
+
+class TestHistory:
+    # whether each test of a program passed in its last run and how long it
+    # took. the next run starts with the tests that failed and, when tests
+    # run side by side, with the longest ones so the workers finish together.
+    # only the most recently run programs are kept.
+    MAX_PROGRAMS = 256
+    default = None
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.programs = {}  # source path -> test name -> [passed, runtime]
+
+    @classmethod
+    def load(cls, path):
+        history = cls(path)
+        with contextlib.suppress(OSError, ValueError):
+            with open(history.path, "r") as f:
+                history.programs = json.load(f)
+        return history
+
+    @classmethod
+    def get_default(cls):
+        with cls.lock:
+            if cls.default is None:
+                cls.default = cls.load(os.path.join(CACHE_DIR, HISTORY_FILE))
+        return cls.default
+
+    def order(self, srcpath, cases, parallel=False):
+        past = self.programs.get(os.path.abspath(srcpath), {})
+
+        def key(case):
+            passed, runtime = past.get(case.name, (True, 0.0))
+            return passed, -runtime if parallel else 0.0
+
+        return sorted(cases, key=key)
+
+    def record(self, srcpath, report):
+        with TestHistory.lock:
+            tests = self.programs.pop(os.path.abspath(srcpath), {})
+            for result in report.results:
+                if not result.skipped:
+                    runtime = round(result.runtime or 0.0, 3)
+                    tests[result.id] = [result.is_passing(), runtime]
+            self.programs[os.path.abspath(srcpath)] = tests
+            while len(self.programs) > TestHistory.MAX_PROGRAMS:
+                del self.programs[next(iter(self.programs))]
+            data = json.dumps(self.programs)
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                f.write(data)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            pass  # the history only changes the order tests run in
+
 
 @contextlib.contextmanager
 def cwd(path):
@@ -179,14 +1228,86 @@ def cwd(path):
         os.chdir(owd)
 
 
-def load_pycodestyle(pycodestyle_src):
+class StyleChecker:
+    # pycodestyle collects messages in one shared report, so only one file is
+    # checked at a time. messages are remembered by the contents of the file.
+
+    def __init__(self, guide, key):
+        self.guide = guide
+        self.key = key
+        self.memo = {}
+        self.lock = threading.Lock()
+
+    def check(self, srcpath, cache=None):
+        digest = hashlib.sha256()
+        for part in ("style", self.key, os.path.basename(srcpath)):
+            digest.update(part.encode("utf-8") + b"\0")
+        with open(srcpath, "rb") as f:
+            digest.update(f.read())
+        key = digest.hexdigest()
+
+        with self.lock:
+            messages = self.memo.get(key)
+            if messages is None and cache is not None:
+                messages = cache.get(key)
+            if messages is None:
+                messages = self.guide.check_files([srcpath]).get_messages()
+                if cache is not None:
+                    cache.put(key, messages)
+            self.memo[key] = messages
+        return list(messages)
+
+
+_style_checkers = {}
+
+
+def _content_key(path):
+    # what a file holds: the zip directory already has a checksum for every
+    # member, other files are hashed
+    if isinstance(path, zipfile.Path):
+        info = path.root.getinfo(path.at)
+        return "{i.CRC:08x}-{i.file_size:d}".format(i=info)
+    return hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+
+
+def _module_key(src):
+    return "{name:s}-{tag:s}-{content:s}".format(
+        name=src.name, tag=sys.implementation.cache_tag, content=_content_key(src)
+    )
+
+
+def _compile_module(src, key, cache=None, filename=None):
+    # compiled code is kept as marshalled bytecode, so the source doesn't have
+    # to be parsed again until it changes
+    code = None
+    if cache is not None:
+        with contextlib.suppress(Exception):
+            code = marshal.loads(cache.get(key))
+    if code is None:
+        # code that warns as it compiles isn't kept, so its warnings are
+        # given again the next time
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            code = compile(src.read_bytes(), filename or src.name, "exec")
+        for w in caught:
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+        if cache is not None and not caught:
+            cache.put(key, marshal.dumps(code))
+    return code
+
+
+def load_pycodestyle(pycodestyle_src, cache=None):
     try:
+        key = _module_key(pycodestyle_src)
+        if key in _style_checkers:
+            return _style_checkers[key]
+
         spec = importlib.util.spec_from_loader(
             "pycodestyle", loader=None, origin="pycodestyle.py"
         )
         pycodestyle = importlib.util.module_from_spec(spec)
         pycodestyle.__file__ = __file__
-        exec(pycodestyle_src.read_text(), pycodestyle.__dict__)
+        exec(_compile_module(pycodestyle_src, key, cache), pycodestyle.__dict__)
 
         class StoredReport(pycodestyle.BaseReport):
             """Collect and results of the checks."""
@@ -226,67 +1347,897 @@ def load_pycodestyle(pycodestyle_src):
                 return messages
 
         # setup code checker with the correct style warnings
-        return pycodestyle.StyleGuide(
+        guide = pycodestyle.StyleGuide(
             max_line_length=120, reporter=StoredReport, ignore=IGNORED_STYLE_ERRORS
         )
+        checker = _style_checkers[key] = StyleChecker(guide, key)
+        return checker
     except:
         traceback.print_exc()
         pass
     return None
 
 
-def run_interactive(cmd, stdin, source=None, tlimit=1_000_000):
+# a warm interpreter that forks a fresh child for every program run, so tests
+# don't pay for python startup each time. the child is set up to look like
+# `python source.py` was run in the workspace: stdin/stdout/stderr are the
+# pipes handed over with the request, and exceptions/exit codes are reported
+# the same way the interpreter would report them.
+FORK_SERVER_SRC = r"""
+import os, sys, io, json, types, socket, signal, select, marshal, builtins, traceback
+import contextvars, locale, warnings, atexit, gc
+
+def stream(fd, mode, **kwargs):
+    # same buffering as the interpreter would give a pipe (honors python -u)
+    unbuffered = bool(os.environ.get("PYTHONUNBUFFERED")) and mode == "w"
+    raw = open(fd, mode + "b", 0 if unbuffered else -1, closefd=False)
+    return io.TextIOWrapper(raw, write_through=unbuffered, **kwargs)
+
+codes = {}  # compiled programs, by path and mtime/size or by code file
+MAX_CODES = 32
+
+def remember(key, code):
+    codes[key] = code
+    while len(codes) > MAX_CODES:
+        del codes[next(iter(codes))]
+    return code
+
+def load_code(request):
+    # the grader's marshalled code for the program, if it sent one
+    path = request.get("code")
+    if not path:
+        return None
+    try:
+        code = codes.get(path)
+        if code is None:
+            with open(path, "rb") as f:
+                code = remember(path, marshal.load(f))
+        return code
+    except Exception:
+        return None  # the program is compiled from its source instead
+
+def set_streams(fds):
+    sys.stdin = sys.__stdin__ = stream(fds[0], "r")
+    sys.stdout = sys.__stdout__ = stream(fds[1], "w")
+    sys.stderr = sys.__stderr__ = stream(
+        fds[2], "w", errors="backslashreplace", line_buffering=True
+    )
+
+def flush_streams():
+    for out in (sys.stdout, sys.stderr):
+        try:
+            out.flush()
+        except BaseException:
+            pass
+
+def shut_down(main):
+    # what the interpreter does once a program is done: wait for its
+    # threads, run its atexit handlers and let go of its objects, so that
+    # files it never closed are flushed, then flush the streams
+    threading = sys.modules.get("threading")
+    if threading is not None:
+        threading._shutdown()
+    atexit._run_exitfuncs()
+    main.__dict__.clear()
+    gc.collect()
+    flush_streams()
+
+def compile_program(source, path, key):
+    # warnings go to the program's stderr, and code that warns isn't kept,
+    # so that every run warns just like a program compiling itself
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        code = compile(source, path, "exec")
+    for w in caught:
+        warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+    return code if caught else remember(key, code)
+
+def run_program(request, code=None):
+    # run the program as __main__ and return its exit status
+    path = os.path.abspath(request["argv"][0])
+    sys.argv = list(request["argv"])
+    sys.path[0] = os.path.dirname(path)
+    main = types.ModuleType("__main__")
+    main.__file__ = path
+    main.__builtins__ = builtins
+    sys.modules["__main__"] = main
+    try:
+        if code is None:
+            stat = os.stat(path)
+            key = (path, stat.st_mtime_ns, stat.st_size)
+            code = codes.get(key)
+        if code is None:
+            with open(path, "rb") as f:
+                code = compile_program(f.read(), path, key)
+        exec(code, main.__dict__)
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        elif isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+    else:
+        return 0
+    return 1
+
+def run_child(request, fds, closing, code):
+    status = 1
+    try:
+        for fd in closing:
+            os.close(fd)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        if request["limits"]:
+            import resource
+            for name, soft, hard in request["limits"]:
+                resource.setrlimit(getattr(resource, name), (soft, hard))
+
+        set_streams([0, 1, 2])
+        status = run_program(request, code)
+        shut_down(sys.modules["__main__"])
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        flush_streams()
+        os._exit(status & 0xFF)
+
+def run_inprocess(request, fds, code):
+    # the program runs in the server itself, without a fork. it runs in an
+    # empty context, so context variables (decimal's context, for one) start
+    # out fresh. afterwards its streams, argv, path, cwd, environment,
+    # recursion limit, signal handlers, locale and warning filters are put
+    # back, and every module it imported is dropped. modules the server had
+    # imported before are shared, and a program that leaves threads running
+    # can't be undone, so it asks for the server to be replaced. a program
+    # that runs too long is stopped by the grader killing the whole server.
+    # the server registers no atexit handlers of its own, so the ones there
+    # after a run are the program's: they run at its shutdown, and are then
+    # cleared. the server's peak memory isn't the program's, so that's
+    # reported as unknown
+    import resource
+    saved = (sys.stdin, sys.stdout, sys.stderr)
+    saved_main, saved_argv, saved_path = sys.modules["__main__"], sys.argv, sys.path[:]
+    saved_limit, saved_cwd, modules = sys.getrecursionlimit(), os.getcwd(), set(sys.modules)
+    saved_environ, saved_locale = dict(os.environ), locale.setlocale(locale.LC_ALL)
+    saved_signals = {x: signal.getsignal(x) for x in signal.valid_signals()}
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    status = 1
+    try:
+        os.chdir(request["cwd"])
+        set_streams(fds)
+        with warnings.catch_warnings():
+            context = contextvars.Context()
+            status = context.run(run_program, request, code)
+            context.run(shut_down, sys.modules["__main__"])
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        atexit._clear()
+        flush_streams()
+        for fd in fds:
+            os.close(fd)
+        threading = sys.modules.get("threading")
+        recycle = threading is not None and threading.active_count() > 1
+        sys.stdin, sys.stdout, sys.stderr = saved
+        sys.__stdin__, sys.__stdout__, sys.__stderr__ = saved
+        sys.modules["__main__"], sys.argv, sys.path[:] = saved_main, saved_argv, saved_path
+        sys.setrecursionlimit(saved_limit)
+        os.chdir(saved_cwd)
+        if os.environ != saved_environ:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+        if locale.setlocale(locale.LC_ALL) != saved_locale:
+            locale.setlocale(locale.LC_ALL, saved_locale)
+        for signum, handler in saved_signals.items():
+            if handler is not None and signal.getsignal(signum) is not handler:
+                signal.signal(signum, handler)
+        for name in set(sys.modules) - modules:
+            del sys.modules[name]
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    usage = [
+        after.ru_utime - before.ru_utime,
+        after.ru_stime - before.ru_stime,
+        None,
+    ]
+    return status & 0xFF, usage, recycle
+
+def serve(sock):
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl+c is the grader's to handle
+
+    while True:
+        ready = select.select([sock, wake_r, 0], [], [])[0]
+        if 0 in ready and not os.read(0, 512):
+            return  # grader went away
+        if wake_r in ready:
+            os.read(wake_r, 512)
+            while True:
+                try:
+                    pid, status, usage = os.wait4(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                code = os.waitstatus_to_exitcode(status)
+                usage = [usage.ru_utime, usage.ru_stime, usage.ru_maxrss]
+                reply = {"pid": pid, "status": code, "usage": usage}
+                sock.send(json.dumps(reply).encode())
+        if sock in ready:
+            msg, fds, _, _ = socket.recv_fds(sock, 1 << 16, 3)
+            request = json.loads(msg)
+            code = load_code(request)  # loaded once, and inherited by children
+            if request.get("inprocess"):
+                pid = os.getpid()
+                sock.send(json.dumps({"pid": pid}).encode())
+                status, usage, recycle = run_inprocess(request, fds, code)
+                reply = {"pid": pid, "status": status, "usage": usage, "recycle": recycle}
+                sock.send(json.dumps(reply).encode())
+                continue
+            try:
+                pid = os.fork()
+            except OSError as e:
+                sock.send(json.dumps({"error": str(e)}).encode())
+                pid = None
+            if pid == 0:
+                run_child(request, fds, [sock.fileno(), wake_r, wake_w], code)
+            for fd in fds:
+                os.close(fd)
+            if pid is not None:
+                sock.send(json.dumps({"pid": pid}).encode())
+
+serve(socket.socket(fileno=int(sys.argv[1])))
+"""
+
+FORK_SUPPORTED = hasattr(os, "fork") and hasattr(socket, "send_fds")
+RUSAGE_SUPPORTED = hasattr(os, "wait4")
+RUNNERS = ("fork", "exec") if FORK_SUPPORTED else ("exec",)
+DEFAULT_RUNNER = RUNNERS[0]
+
+
+class ResourceUsage:
+    def __init__(self, user=0.0, system=0.0, maxrss=0):
+        self.user = user  # cpu seconds
+        self.system = system
+        self.maxrss = None  # bytes, None when unknown
+        if maxrss is not None:
+            self.maxrss = maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    def cpu_time(self):
+        return self.user + self.system
+
+
+def _get_rlimits(memory_limit=None, cpu_limit=None):
+    # (name, soft, hard) for the resource module; going over the soft cpu
+    # limit sends SIGXCPU, the hard limit a second later kills outright
+    limits = []
+    if memory_limit:
+        limits.append(("RLIMIT_AS", memory_limit, memory_limit))
+    if cpu_limit:
+        limits.append(("RLIMIT_CPU", cpu_limit, cpu_limit + 1))
+    return limits
+
+
+def _set_rlimits(limits):
+    # runs in the child between fork and exec, where importing isn't safe
+    # while the grader has other threads, so resource is imported up front
+    for name, soft, hard in limits:
+        resource.setrlimit(getattr(resource, name), (soft, hard))
+
+
+async def _open_pipes(stdin_w, stdout_r, stderr_r):
+    # the parent's ends of a child's pipes, as asyncio streams
+    loop = asyncio.get_running_loop()
+    streams = []
+    for fd in (stdout_r, stderr_r):
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), open(fd, "rb", 0)
+        )
+        streams.append(reader)
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, open(stdin_w, "wb", 0)
+    )
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    return [writer] + streams
+
+
+class _ForkedProcess:
+    # the parts of asyncio.subprocess.Process that run_interactive relies on.
+    # an in-process program is the server itself, so killing it kills the
+    # server, and no reply comes when that happens
+
+    def __init__(self, server, pid, stdin, stdout, stderr, inprocess=False):
+        self._server = server
+        self._transport = None
+        self.pid = pid
+        self.stdin, self.stdout, self.stderr = stdin, stdout, stderr
+        self.inprocess = inprocess
+        self.returncode = None
+        self.usage = None
+
+    async def wait(self):
+        if self.returncode is None:
+            reply = None
+            if self.inprocess:
+                while reply is None and self._server.proc.poll() is None:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        reply = await asyncio.wait_for(self._server.receive(), 0.1)
+                if reply is None:
+                    reply = {"status": self._server.proc.returncode, "usage": []}
+            else:
+                reply = await self._server.receive()
+            self.returncode = reply["status"]
+            self.usage = ResourceUsage(*reply["usage"])
+            self._server.pending = self._server.proc.poll() is not None or reply.get(
+                "recycle", False
+            )
+            self.stdin.close()
+        return self.returncode
+
+    def kill(self):
+        if self.inprocess:
+            self._server.proc.kill()
+            return
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(self.pid, signal.SIGKILL)
+
+
+class _ForkServer:
+    REPLY_TIMEOUT = 5
+    idle = []
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.sock, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", FORK_SERVER_SRC, str(remote.fileno())],
+            stdin=subprocess.PIPE,
+            pass_fds=[remote.fileno()],
+        )
+        remote.close()
+        self.sock.setblocking(False)
+        self.pending = False
+
+    @classmethod
+    def acquire(cls):
+        with cls.lock:
+            while cls.idle:
+                server = cls.idle.pop()
+                if server.proc.poll() is None:
+                    return server
+        return cls()
+
+    def release(self):
+        # a server with a reply still in flight can't be trusted with more
+        # work, nor one that a program ran in and couldn't be cleaned up after
+        if self.pending:
+            self.proc.kill()
+            self.close()
+            return
+        with _ForkServer.lock:
+            _ForkServer.idle.append(self)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.sock.close()
+        self.proc.wait()
+
+    @classmethod
+    def shutdown(cls):
+        with cls.lock:
+            servers, cls.idle = cls.idle, []
+        for server in servers:
+            server.close()
+
+    async def receive(self):
+        loop = asyncio.get_running_loop()
+        reply = await asyncio.wait_for(
+            loop.sock_recv(self.sock, 1 << 16), _ForkServer.REPLY_TIMEOUT
+        )
+        reply = json.loads(reply)
+        if "error" in reply:
+            raise OSError(reply["error"])
+        return reply
+
+    async def spawn(self, argv, cwd, limits=(), inprocess=False, code=None):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        self.pending = True
+        try:
+            request = json.dumps(
+                {
+                    "argv": argv,
+                    "cwd": cwd or os.getcwd(),
+                    "limits": list(limits),
+                    "inprocess": inprocess,
+                    "code": code,
+                }
+            )
+            socket.send_fds(
+                self.sock, [request.encode()], [stdin_r, stdout_w, stderr_w]
+            )
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        pid = (await self.receive())["pid"]
+        pipes = await _open_pipes(stdin_w, stdout_r, stderr_r)
+        return _ForkedProcess(self, pid, *pipes, inprocess=inprocess)
+
+
+atexit.register(_ForkServer.shutdown)
+
+
+class _WaitedProcess:
+    # a normal child process, but reaped with wait4 so its resource usage is
+    # known. the wait happens on a thread of its own, like asyncio's default
+    # child watcher, so a busy executor can't delay it.
+
+    def __init__(self, pid, stdin, stdout, stderr):
+        self._transport = None
+        self.pid = pid
+        self.stdin, self.stdout, self.stderr = stdin, stdout, stderr
+        self.returncode = None
+        self.usage = None
+
+        loop = asyncio.get_running_loop()
+        self._exited = loop.create_future()
+
+        def reap():
+            result = os.wait4(pid, 0)
+            with contextlib.suppress(RuntimeError):  # loop may already be closed
+                loop.call_soon_threadsafe(
+                    lambda: self._exited.done() or self._exited.set_result(result)
+                )
+
+        threading.Thread(target=reap, daemon=True).start()
+
+    @classmethod
+    async def spawn(cls, cmd, cwd, limits=()):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                cwd=cwd,
+                stdin=stdin_r,
+                stdout=stdout_w,
+                stderr=stderr_w,
+                preexec_fn=(lambda: _set_rlimits(limits)) if limits else None,
+            )
+        except BaseException:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        proc.returncode = 0  # reaped here, Popen must not wait for it as well
+        return cls(proc.pid, *await _open_pipes(stdin_w, stdout_r, stderr_r))
+
+    async def wait(self):
+        if self.returncode is None:
+            _, status, usage = await asyncio.shield(self._exited)
+            self.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = ResourceUsage(usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+            self.stdin.close()
+        return self.returncode
+
+    def kill(self):
+        if not self._exited.done():
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(self.pid, signal.SIGKILL)
+
+
+class OutputMatcher:
+    # compares console output with the expected text as it arrives. anything
+    # before the first mismatch is known to equal the expected text, so only
+    # the output after it is kept (up to `window` characters) for feedback.
+    NEWLINES = re.compile(r"[\r\n]+")
+
+    def __init__(self, expect, window=DIFF_WINDOW):
+        self.expect = expect
+        self.window = window
+        self.matched = 0
+        self.mismatch = None
+        self.stopped = False
+        self.truncated = False
+        self._tail = []
+        self._tail_size = 0
+        self._newline = False
+
+    def feed(self, text):
+        # newline runs are squashed the same way whole outputs used to be
+        text = OutputMatcher.NEWLINES.sub("\n", text)
+        if self._newline and text.startswith("\n"):
+            text = text[1:]
+        if not text:
+            return self.mismatch is None
+        self._newline = text.endswith("\n")
+
+        if self.mismatch is None:
+            if self.expect.startswith(text, self.matched):
+                self.matched += len(text)
+                return True
+            expect = self.expect[self.matched : self.matched + len(text)]
+            same = len(os.path.commonprefix([expect, text]))
+            self.matched += same
+            self.mismatch = self.matched
+            text = text[same:]
+
+        room = self.window - self._tail_size
+        if len(text) > room:
+            text, self.truncated = text[:room], True
+        self._tail.append(text)
+        self._tail_size += len(text)
+        return False
+
+    def finish(self):
+        if self.mismatch is None and self.matched != len(self.expect):
+            self.mismatch = self.matched
+        return self.mismatch is None
+
+    def get_actual(self):
+        if self.mismatch is None:
+            return self.expect[: self.matched]
+        return self.expect[: self.mismatch] + "".join(self._tail)
+
+
+class OutputComparator:
+    # a check_output for the tolerant `compare` modes of [grader-config]:
+    #   whitespace: runs of spaces and tabs don't matter
+    #   numeric: as whitespace, and numbers only have to be close, within
+    #     `abs-tolerance` or `rel-tolerance` (math.isclose)
+    #   regex: exact lines, except for the parts that `mask` matches
+    # a `mask` applies in the other modes too. both outputs are read a line
+    # at a time, side by side, and blank lines are skipped.
+    MODES = ("exact", "whitespace", "numeric", "regex")
+    NUMBER = re.compile(r"([-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)")
+    FEEDBACK_LINES = 5
+
+    def __init__(self, mode, mask=None, abs_tolerance=0.0, rel_tolerance=1e-9):
+        self.mode = mode
+        self.mask = re.compile(mask) if mask else None
+        self.abs_tolerance = abs_tolerance
+        self.rel_tolerance = rel_tolerance
+
+    @classmethod
+    def from_config(cls, config):
+        # None for plain exact comparison
+        mode = config.get("grader-config", "compare", fallback="exact")
+        mask = config.get("grader-config", "mask", raw=True, fallback=None)
+        if mode not in cls.MODES:
+            raise GraderException("Unknown output comparison: {:s}".format(mode))
+        if mode == "regex" and not mask:
+            raise GraderException("compare = regex needs a mask")
+        if mode == "exact" and not mask:
+            return None
+        return cls(
+            mode,
+            mask=mask,
+            abs_tolerance=config.getfloat(
+                "grader-config", "abs-tolerance", fallback=0.0
+            ),
+            rel_tolerance=config.getfloat(
+                "grader-config", "rel-tolerance", fallback=1e-9
+            ),
+        )
+
+    def normalize(self, line):
+        if self.mask is not None:
+            line = self.mask.sub("\0", line)
+        if self.mode == "numeric":
+            # text and numbers alternate: [text, number, text, ...]
+            parts = OutputComparator.NUMBER.split(line)
+            parts[::2] = [" ".join(x.split()) for x in parts[::2]]
+            return parts
+        if self.mode == "whitespace":
+            return " ".join(line.split())
+        return line
+
+    def lines(self, stream):
+        for n, line in enumerate(stream, 1):
+            line = line.rstrip("\r\n")
+            if line.strip():
+                yield n, line, self.normalize(line)
+
+    def same(self, actual, expect):
+        if self.mode != "numeric":
+            return actual == expect
+        if len(actual) != len(expect) or actual[::2] != expect[::2]:
+            return False
+        return all(
+            math.isclose(
+                float(a),
+                float(e),
+                rel_tol=self.rel_tolerance,
+                abs_tol=self.abs_tolerance,
+            )
+            for a, e in zip(actual[1::2], expect[1::2])
+        )
+
+    def describe(self, actual, expect):
+        def show(line):
+            return repr(line if len(line) <= 80 else line[:77] + "...")
+
+        if expect is None:
+            return "line {n:d}: unexpected output {a:s}".format(
+                n=actual[0], a=show(actual[1])
+            )
+        if actual is None:
+            return "output ended, expected {e:s}".format(e=show(expect[1]))
+        return "line {n:d}: expected {e:s}, got {a:s}".format(
+            n=actual[0], e=show(expect[1]), a=show(actual[1])
+        )
+
+    def __call__(self, actual, expect, type="stdout"):
+        differences, feedback = 0, []
+        for a, e in itertools.zip_longest(self.lines(actual), self.lines(expect)):
+            if a is not None and e is not None and self.same(a[2], e[2]):
+                continue
+            differences += 1
+            if differences <= OutputComparator.FEEDBACK_LINES:
+                feedback.append(self.describe(a, e))
+        if not differences:
+            return True, None
+
+        if differences > len(feedback):
+            feedback.append("... and {n:d} more".format(n=differences - len(feedback)))
+        if self.mode == "numeric":
+            feedback.insert(
+                0,
+                "(numbers may differ by {a:g}, or by {r:g} of the expected value)".format(
+                    a=self.abs_tolerance, r=self.rel_tolerance
+                ),
+            )
+        return False, "\n".join(feedback)
+
+
+class RepeatedRuns:
+    # the verdict on a test of a randomized program, run up to `runs` times.
+    # every run passes or fails on its own, and the test passes when at least
+    # `pass-rate` of its runs can be expected to pass. after each run, a
+    # Wilson interval (at `confidence`) is worked out for the fraction of
+    # passing runs, and the runs stop once it lies entirely above or below
+    # `pass-rate`. a test still undecided after all of its runs is settled by
+    # the fraction that passed.
+    def __init__(self, runs, pass_rate=0.5, confidence=0.95):
+        self.runs = runs
+        self.pass_rate = pass_rate
+        self.confidence = confidence
+        self.z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        self.count = 0
+        self.passed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        # None for a test that runs once
+        runs = config.getint("grader-config", "runs", fallback=1)
+        if runs <= 1:
+            return None
+        pass_rate = config.getfloat("grader-config", "pass-rate", fallback=0.5)
+        confidence = config.getfloat("grader-config", "confidence", fallback=0.95)
+        if not 0 < pass_rate <= 1:
+            raise GraderException("pass-rate must be above 0, and at most 1")
+        if not 0 < confidence < 1:
+            raise GraderException("confidence must be between 0 and 1")
+        return cls(runs, pass_rate=pass_rate, confidence=confidence)
+
+    def add(self, passed):
+        self.count += 1
+        if passed:
+            self.passed += 1
+
+    def interval(self):
+        n, z = self.count, self.z
+        rate = self.passed / n
+        centre = (rate + z * z / (2 * n)) / (1 + z * z / n)
+        spread = (
+            z / (1 + z * z / n) * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n))
+        )
+        return max(0.0, centre - spread), min(1.0, centre + spread)
+
+    def verdict(self):
+        # True or False once decided, None while more runs are needed
+        low, high = self.interval()
+        if low > self.pass_rate:
+            return True
+        if high < self.pass_rate:
+            return False
+        if self.count >= self.runs:
+            return self.passed >= self.pass_rate * self.count
+        return None
+
+    def describe(self):
+        low, high = self.interval()
+        return "passed {p:d} of {n:d} runs ({rate:.0%}, {c:.0%} interval {low:.0%} to {high:.0%}), {need:.0%} needed".format(
+            p=self.passed,
+            n=self.count,
+            rate=self.passed / self.count,
+            c=self.confidence,
+            low=low,
+            high=high,
+            need=self.pass_rate,
+        )
+
+
+class _OutputMismatch(Exception):
+    pass
+
+
+async def run_interactive_async(
+    cmd,
+    stdin,
+    source=None,
+    tlimit=1_000_000,
+    cwd=None,
+    runner=DEFAULT_RUNNER,
+    matcher=None,
+    stop_on_mismatch=False,
+    memory_limit=None,
+    cpu_limit=None,
+    code=None,
+):
+    # with a matcher, output is compared as it is read instead of collected,
+    # and None is returned in place of the output text. resource usage is
+    # returned where the platform can report it (otherwise None), and the
+    # memory (bytes) and cpu (seconds) limits are only enforced there too.
+    # `code` is a file of the program's marshalled code, which programs
+    # started from the fork server run instead of compiling the source
     if source is None:
         source = cmd[1]  # TODO: remove this hack
 
-    async def get_line(output, pipe):
-        line = await pipe.read(1024 * 16)
-        output.append(
-            line.decode(encoding=sys.stdout.encoding, errors="backslashreplace")
-        )
+    limits = _get_rlimits(memory_limit, cpu_limit) if RUSAGE_SUPPORTED else []
 
-    async def __run():
-        tt = time.monotonic()
-        proc = await asyncio.subprocess.create_subprocess_exec(
+    # only plain python programs can be started from the fork server. limits
+    # can't be set on a program that runs inside the server, so it is forked
+    server = None
+    inprocess = runner == "inprocess" and not limits
+    if runner in ("fork", "inprocess") and FORK_SUPPORTED and cmd[0] == sys.executable:
+        server = _ForkServer.acquire()
+
+    async def spawn():
+        if server is not None:
+            try:
+                return await server.spawn(list(cmd[1:]), cwd, limits, inprocess, code)
+            except (OSError, asyncio.TimeoutError):
+                traceback.print_exc()  # fall through to a normal process
+        if RUSAGE_SUPPORTED:
+            return await _WaitedProcess.spawn(cmd, cwd, limits)
+        return await asyncio.subprocess.create_subprocess_exec(
             *cmd,
+            cwd=cwd,
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
 
-        output = []
+    output = []
+    decoder = codecs.getincrementaldecoder(sys.stdout.encoding)("backslashreplace")
+
+    def collect(text):
+        if matcher is None:
+            output.append(text)
+        elif not matcher.feed(text) and stop_on_mismatch:
+            raise _OutputMismatch()
+
+    async def get_line(pipe):
+        collect(decoder.decode(await pipe.read(1024 * 16)))
+
+    async def get_rest(pipe):
+        while True:
+            chunk = await pipe.read(1024 * 16)
+            if not chunk:
+                break
+            collect(decoder.decode(chunk))
+        collect(decoder.decode(b"", final=True))
+
+    try:
+        tt = time.monotonic()
+        proc = await spawn()
+        spawned = time.monotonic()
+        PhaseTimer.record("spawn", spawned - tt)
+
         exitcode, err = None, ""
         try:
             for line in (x for x in stdin.splitlines(keepends=True) if x):
-                await asyncio.wait_for(get_line(output, proc.stdout), tlimit)
+                await asyncio.wait_for(get_line(proc.stdout), tlimit)
                 if time.monotonic() - tt > tlimit:
                     raise asyncio.TimeoutError("aggregate process time expired")
-                output.append(line)
+                collect(line)
                 proc.stdin.write(line.encode("utf-8"))
-            await asyncio.wait_for(get_line(output, proc.stdout), tlimit)
+            await asyncio.wait_for(get_rest(proc.stdout), tlimit)
             await asyncio.wait_for(proc.wait(), tlimit)
 
             exitcode = proc.returncode
             err = await proc.stderr.read()
             err = err.decode(encoding=sys.stderr.encoding, errors="backslashreplace")
 
-        except asyncio.TimeoutError:
+        except (asyncio.TimeoutError, _OutputMismatch) as e:
             proc.kill()
             if proc._transport:  # this is a HACK
                 proc._transport.close()
             await proc.wait()
+            if isinstance(e, _OutputMismatch):
+                matcher.stopped = True
+                exitcode = proc.returncode
+        except BaseException:
+            # cancelled, when another test failed the grading or on ctrl+c,
+            # the program mustn't be left running
+            if proc.returncode is None:
+                proc.kill()
+                if proc._transport:
+                    proc._transport.close()
+                await proc.wait()
+            raise
 
         runtime = time.monotonic() - tt
-        if runtime >= tlimit:
+        PhaseTimer.record("run", tt + runtime - spawned)
+        usage = getattr(proc, "usage", None)
+        if runtime >= tlimit and not (matcher and matcher.stopped):
             err = "[{source:s}] maximum runtime allowance ({limit:.2f} seconds) exceeded".format(
                 source=source, limit=tlimit
             )
             exitcode = None
+        elif (
+            cpu_limit
+            and usage is not None
+            and (
+                usage.cpu_time() >= cpu_limit
+                or exitcode == -getattr(signal, "SIGXCPU", 0)
+            )
+        ):
+            err = "[{source:s}] cpu time limit ({limit:.2f} seconds) exceeded".format(
+                source=source, limit=cpu_limit
+            )
 
-        output_text = re.sub(r"[\r\n]+", r"\n", "".join(output))
-        return exitcode, output_text, err, runtime
-
-    return asyncio.run(__run())
+        output_text = None
+        if matcher is None:
+            output_text = re.sub(r"[\r\n]+", r"\n", "".join(output))
+        return exitcode, output_text, err, runtime, usage
+    finally:
+        if server is not None:
+            server.release()
+
+
+def run_interactive(
+    cmd,
+    stdin,
+    source=None,
+    tlimit=1_000_000,
+    cwd=None,
+    runner=DEFAULT_RUNNER,
+    matcher=None,
+    stop_on_mismatch=False,
+    memory_limit=None,
+    cpu_limit=None,
+):
+    return asyncio.run(
+        run_interactive_async(
+            cmd,
+            stdin,
+            source=source,
+            tlimit=tlimit,
+            cwd=cwd,
+            runner=runner,
+            matcher=matcher,
+            stop_on_mismatch=stop_on_mismatch,
+            memory_limit=memory_limit,
+            cpu_limit=cpu_limit,
+        )
+    )
 
 
 def error_cleanup(msg):
@@ -322,7 +2273,40 @@ def print_report_progress(report, x):
     print_progress(report.source, x, report.tests, failed=x - report.count_passed())
 
 
-def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
+def test_one(
+    folder,
+    srcpath=None,
+    config=None,
+    style=None,
+    quiet=False,
+    options=None,
+    calibration=None,
+):
+    yield from _iterate_async(
+        test_one_async(
+            folder,
+            srcpath=srcpath,
+            config=config,
+            style=style,
+            quiet=quiet,
+            options=options,
+            calibration=calibration,
+        )
+    )
+
+
+async def test_one_async(
+    folder,
+    srcpath=None,
+    config=None,
+    style=None,
+    quiet=False,
+    options=None,
+    suite=None,
+    gate=None,
+    calibration=None,
+):
+    options = options or GraderOptions()
     console_error = NOOP if quiet else write_error
     console_msg = NOOP if quiet else print
 
@@ -341,7 +2325,10 @@ def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
 
     if not os.path.exists(srcpath):
         message = ["Source file {src:s} is missing. Tests omitted.".format(src=source)]
-        m = difflib.get_close_matches(source, glob.iglob("*.py"), n=1, cutoff=0.8)
+        nearby = glob.iglob(os.path.join(glob.escape(os.path.dirname(srcpath)), "*.py"))
+        m = difflib.get_close_matches(
+            source, [os.path.basename(x) for x in nearby], n=1, cutoff=0.8
+        )
         if len(m) > 0:
             message.append(
                 "This name looks close, perhaps a typo? {matches[0]:s}".format(
@@ -354,19 +2341,6 @@ def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
         ).make_error()
         return
 
-    def make_text_stream(x, config):
-        # for really specific file encoding issues
-        encoding_flags = dict()
-        enc = config.get("grader-config", "encoding", fallback=None)
-        if enc:
-            encoding_flags["encoding"] = enc
-            encoding_flags["errors"] = "ignore"
-        return (
-            x
-            if isinstance(x, io.TextIOWrapper)
-            else io.TextIOWrapper(x, **encoding_flags)
-        )
-
     # return (match, feedback)
     # if feedback is None, diff of outputs will be used for feedback
     def output_matches(a, b, type):
@@ -421,45 +2395,119 @@ def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
             ).make_error()
             return
 
+    # the program is compiled once, so a syntax error is reported once rather
+    # than by every test, and programs started from the fork server don't
+    # compile it again. compile warnings belong on the program's stderr, so
+    # code that warns is left for each run to compile (and warn) itself
+    try:
+        program = pathlib.Path(srcpath)
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter("always")
+            code = _compile_module(
+                program,
+                "program-" + _module_key(program),
+                cache=ResultCache() if options.cache else None,
+                filename=os.path.abspath(srcpath),
+            )
+    except (SyntaxError, ValueError):
+        message = error_cleanup(
+            "".join(traceback.format_exception_only(*sys.exc_info()[:2]))
+        )
+        console_error(
+            "Syntax error in {src:s}:\n{msg:s}".format(src=source, msg=message)
+        )
+        yield GraderReport(source, error=message).make_error()
+        return
+
+    runner = config.get("grader-config", "runner", fallback=options.runner)
+    stop_on_mismatch = config.getboolean(
+        "grader-config", "stop-on-mismatch", fallback=options.stop_on_mismatch
+    )
+    if runner not in RUNNERS:
+        runner = "exec"
+    # programs that only use stdin and stdout can opt in to running inside the
+    # fork server, without a process of their own per test
+    mode = config.get("grader-config", "mode", fallback=None)
+    if mode == "inprocess" and FORK_SUPPORTED:
+        runner = "inprocess"
+
     report = GraderReport(source=source)
-    report.style_errors = style if style else []
+    pending_style = None
+    if asyncio.isfuture(style):
+        pending_style = style
+    else:
+        report.style_errors = style if style else []
+
+    async def finish(result):
+        # style checks run alongside the tests, the report only needs them
+        # once it is complete
+        if pending_style is not None and report.is_complete():
+            report.style_errors = await pending_style
+        return result
 
     report.timeout = config.getint("grader-config", "timeout", fallback=1)
     report.soft_timeout = config.getint(
         "grader-config", "soft-timeout", fallback=report.timeout
     )
 
+    def set_limits(result):
+        if calibration is not None:
+            result.timeout, result.soft_timeout = calibration.get_limits(
+                source, result.id, report.timeout, report.soft_timeout
+            )
+
     if gmodule and hasattr(gmodule, "grade"):
-        yield from gmodule.grade(sys.modules[__name__], report, errors=report.errors)
+        for result in gmodule.grade(
+            sys.modules[__name__], report, errors=report.errors
+        ):
+            yield await finish(result)
     else:
-        stdin_files = [x for x in folder.iterdir() if x.name.endswith(".stdin")]
-        numtests = len(stdin_files)
-
-        report.tests = numtests
-        for testnum, stdin_file in enumerate(stdin_files):
-            test_id = stdin_file.name.split(".")[0]
 
-            # custom config file per-test supported
-            test_config_file = folder / "{id:s}-config.ini".format(id=test_id)
-            test_config = configparser.ConfigParser()
-            test_config.read_dict(config)
-            if test_config_file.exists():
-                test_config.read_string(
-                    test_config_file.read_text(), source=str(test_config_file)
+        async def run_case(case, skip=False):
+            # this will get marked as failed if we find a mismatch
+            test_result = report.make_result(case.name)
+            set_limits(test_result)
+            if skip:
+                test_result.skip()
+                return test_result
+
+            # a randomized program can be run several times, and is judged by
+            # how many of its runs pass. the result shown is the last run
+            # that agrees with the verdict, and only its runtime errors go in
+            # the report, so runs the verdict outweighs don't count against it
+            repeated = RepeatedRuns.from_config(case.config)
+            if repeated is None:
+                return await run_trial(case, test_result, report.errors)
+
+            shown = {}
+            verdict = None
+            while verdict is None:
+                trial, errors = report.make_result(case.name), set()
+                set_limits(trial)
+                await run_trial(case, trial, errors)
+                repeated.add(trial.is_passing())
+                shown[trial.is_passing()] = (trial, errors)
+                verdict = repeated.verdict()
+
+            test_result, errors = shown.get(verdict, (trial, errors))
+            report.errors.update(errors)
+            if not verdict:
+                test_result.set_score(
+                    score=0.0, info=test_result.info or "too few runs passed"
                 )
+            test_result.attach_output("repeated runs", repeated.describe())
+            return test_result
 
-            test_name = test_config.get(
-                "test-config", "test-name", fallback="#" + test_id
-            )
+        async def run_trial(case, test_result, errors):
+            test_config = case.config
+            test_name = case.name
 
-            # this will get marked as failed if we find a mismatch
-            test_result = report.make_result(test_name)
-
-            with tempfile.TemporaryDirectory() as workspace:
+            setup_start = time.perf_counter()
+            workspace = pool.acquire()
+            try:
                 stdin_text = ""  # text to be input to the process via stdin
                 try:
-                    if stdin_file.exists():
-                        stdin_text = stdin_file.read_text()
+                    stdin_text = (folder / case.stdin).read_text()
                 except:
                     raise GraderException(
                         "\n".join(
@@ -473,157 +2521,197 @@ def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
                         )
                     )
 
-                input_file_tag = "{id:s}-inp-".format(id=test_id)
-                output_file_tag = "{id:s}-out-".format(id=test_id)
-                input_raw_set = set()
-                output_file_set = set()
-
-                for file in folder.iterdir():
-                    if file.name.startswith(input_file_tag):
-                        input_raw_set.add(file.name)
-                        input_file_name = file.name[len(input_file_tag) :]
-                        try:
-                            with open(
-                                os.path.join(workspace, input_file_name), "w"
-                            ) as inpc:
-                                with file.open("r") as inpfd:
-                                    shutil.copyfileobj(
-                                        make_text_stream(inpfd, test_config), inpc
-                                    )
-                        except:
-                            raise GraderException(
-                                "\n".join(
-                                    [
-                                        "Failed to setup input data for testing ({src:s}, test {test:s})".format(
-                                            src=source, test=test_name
-                                        ),
-                                        'Issue with getting input file "{fn:s}" for test case:'.format(
-                                            fn=input_file_name
-                                        ),
-                                        traceback.format_exc(),
-                                    ]
-                                )
+                # a file the case expects the program to rewrite gets a copy
+                rewritten = {name for name, _ in case.outputs}
+                for input_file_name, member in case.inputs:
+                    try:
+                        suite.place(
+                            member,
+                            test_config,
+                            os.path.join(workspace, input_file_name),
+                            link=input_file_name not in rewritten,
+                        )
+                    except:
+                        raise GraderException(
+                            "\n".join(
+                                [
+                                    "Failed to setup input data for testing ({src:s}, test {test:s})".format(
+                                        src=source, test=test_name
+                                    ),
+                                    'Issue with getting input file "{fn:s}" for test case:'.format(
+                                        fn=input_file_name
+                                    ),
+                                    traceback.format_exc(),
+                                ]
                             )
-                    elif file.name.startswith(output_file_tag):
-                        output_file_set.add(file.name[len(output_file_tag) :])
+                        )
 
                 try:
-                    with open(os.path.join(workspace, source), "w") as wsrc:
-                        # open a local file version
-                        with open(srcpath, "r") as source_file:
-                            shutil.copyfileobj(source_file, wsrc)
-
-                    with cwd(workspace):
-                        (
-                            exit_code,
-                            output_text,
-                            stderr,
-                            test_result.runtime,
-                        ) = run_interactive(
-                            [sys.executable, source],
-                            source=source,
-                            stdin=stdin_text,
-                            tlimit=report.timeout,
+                    pool.prepare(workspace)
+
+                    # config.ini can ask for a tolerant comparison, unless a
+                    # custom grader brings its own
+                    compare = check_output
+                    if check_output is output_matches:
+                        compare = (
+                            OutputComparator.from_config(test_config) or output_matches
                         )
 
-                        stdout_file = folder / "{id:s}.stdout".format(id=test_id)
-                        if stdout_file.exists():
-                            actual_output = io.StringIO(output_text)
-                            with stdout_file.open("r") as expected_stream:
-                                expect_output = make_text_stream(
-                                    expected_stream, test_config
-                                )
-                                result, feedback = check_output(
+                    # plain console output is compared while the program runs
+                    stdout_file = folder / case.stdout if case.stdout else None
+                    matcher = None
+                    if stdout_file and compare is output_matches:
+                        with stdout_file.open("r") as expected_stream:
+                            matcher = OutputMatcher(
+                                make_text_stream(expected_stream, test_config).read()
+                            )
+                    PhaseTimer.record("workspace", time.perf_counter() - setup_start)
+
+                    # optional limits: memory in megabytes, cpu time in seconds
+                    memory_limit = test_config.getint(
+                        "grader-config", "memory-limit", fallback=0
+                    )
+                    (
+                        exit_code,
+                        output_text,
+                        stderr,
+                        test_result.runtime,
+                        usage,
+                    ) = await run_interactive_async(
+                        [sys.executable, source],
+                        source=source,
+                        stdin=stdin_text,
+                        tlimit=test_result.get_timeout(),
+                        cwd=workspace,
+                        runner=runner,
+                        matcher=matcher,
+                        stop_on_mismatch=stop_on_mismatch,
+                        memory_limit=memory_limit * 1024 * 1024,
+                        cpu_limit=test_config.getint(
+                            "grader-config", "cpu-limit", fallback=0
+                        ),
+                        code=codefile,
+                    )
+                    stopped = matcher is not None and matcher.stopped
+                    test_result.exit_code = exit_code
+                    if usage is not None:
+                        test_result.cpu_time = usage.cpu_time()
+                        test_result.max_rss = usage.maxrss
+
+                    if matcher is not None:
+                        with PhaseTimer.measure("compare"):
+                            matched = matcher.finish()
+                        if not matched:
+                            test_result.set_score(
+                                score=0.0, info="console output mismatch"
+                            )
+                        test_result.add_diff(
+                            "console output", matcher.get_actual(), matcher.expect
+                        )
+                        if stopped:
+                            test_result.attach_output(
+                                "program stopped at the first mismatch"
+                            )
+                        elif matcher.truncated:
+                            test_result.attach_output(
+                                "console output truncated after the first mismatch"
+                            )
+                    elif stdout_file:
+                        actual_output = io.StringIO(output_text)
+                        with stdout_file.open("r") as expected_stream:
+                            expect_output = make_text_stream(
+                                expected_stream, test_config
+                            )
+                            with PhaseTimer.measure("compare"):
+                                result, feedback = compare(
                                     actual_output, expect_output, type="stdout"
                                 )
-                                if not result:
-                                    test_result.set_score(
-                                        score=0.0, info="console output mismatch"
-                                    )
+                            if not result:
+                                test_result.set_score(
+                                    score=0.0, info="console output mismatch"
+                                )
 
-                                label = "console output"
-                                if feedback is not None:
-                                    test_result.attach_output(label, feedback)
-                                else:
-                                    expect_output.seek(0)
-                                    test_result.add_diff(
-                                        label, output_text, expect_output.read()
-                                    )
+                            label = "console output"
+                            if feedback is not None:
+                                test_result.attach_output(label, feedback)
+                            else:
+                                expect_output.seek(0)
+                                test_result.add_diff(
+                                    label, output_text, expect_output.read()
+                                )
 
-                        for in_filename in input_raw_set:
-                            input_file_name = in_filename[len(input_file_tag) :]
-                            if os.path.getsize(input_file_name) < 10 * 1024:
-                                with open(input_file_name, "r") as inp_file:
-                                    test_result.attach_output(
-                                        "input file: {file:s}".format(
-                                            file=input_file_name
-                                        ),
-                                        inp_file.readlines(),
-                                    )
+                    for input_file_name, _ in case.inputs:
+                        input_file_path = os.path.join(workspace, input_file_name)
+                        if os.path.getsize(input_file_path) < 10 * 1024:
+                            with open(input_file_path, "r") as inp_file:
+                                test_result.attach_output(
+                                    "input file: {file:s}".format(file=input_file_name),
+                                    inp_file.readlines(),
+                                )
 
-                        for out_filename in output_file_set:
-                            if os.path.exists(out_filename):
-                                with open(out_filename, "r") as actual_output:
-                                    zip_file = folder / "{id:s}-out-{base:s}".format(
-                                        id=test_id, base=out_filename
+                    for out_filename, member in case.outputs:
+                        out_filepath = os.path.join(workspace, out_filename)
+                        if os.path.exists(out_filepath):
+                            with open(out_filepath, "r") as actual_output:
+                                zip_file = folder / member
+                                with zip_file.open("r") as expected_stream:
+                                    expect_output = make_text_stream(
+                                        expected_stream, test_config
                                     )
-                                    with zip_file.open("r") as expected_stream:
-                                        expect_output = make_text_stream(
-                                            expected_stream, test_config
-                                        )
-                                        result, feedback = check_output(
+                                    with PhaseTimer.measure("compare"):
+                                        result, feedback = compare(
                                             actual_output,
                                             expect_output,
                                             type="file:" + out_filename,
                                         )
-                                        if not result:
-                                            test_result.set_score(
-                                                score=0.0,
-                                                info="output file contents incorrect: {file:s}".format(
-                                                    file=out_filename
-                                                ),
-                                            )
-
-                                        label = "output file: {file:s}".format(
-                                            file=out_filename
+                                    if not result:
+                                        test_result.set_score(
+                                            score=0.0,
+                                            info="output file contents incorrect: {file:s}".format(
+                                                file=out_filename
+                                            ),
                                         )
-                                        if feedback is not None:
-                                            test_result.attach_output(label, feedback)
-                                        else:
-                                            for x in (actual_output, expect_output):
-                                                x.seek(0)
-                                            test_result.add_diff(
-                                                label,
-                                                actual_output.read(),
-                                                expect_output.read(),
-                                            )
-                            else:
-                                test_result.set_score(
-                                    score=0.0,
-                                    info="file expected, but missing: {file:s}".format(
-                                        file=out_filename
-                                    ),
-                                )
-                                test_result.attach_output(
-                                    "output file missing: {file:s}".format(
-                                        file=out_filename
-                                    ),
-                                    "",
-                                )
 
-                        if exit_code != 0 or len(stderr) > 0:
-                            clean_stderr = error_cleanup(stderr)
-                            test_result.attach_output(
-                                "runtime errors (exit code: {x:s})".format(
-                                    x=str(exit_code)
-                                ),
-                                clean_stderr,
-                            )
+                                    label = "output file: {file:s}".format(
+                                        file=out_filename
+                                    )
+                                    if feedback is not None:
+                                        test_result.attach_output(label, feedback)
+                                    else:
+                                        for x in (actual_output, expect_output):
+                                            x.seek(0)
+                                        test_result.add_diff(
+                                            label,
+                                            actual_output.read(),
+                                            expect_output.read(),
+                                        )
+                        else:
                             test_result.set_score(
                                 score=0.0,
-                                info="runtime errors or nonstandard exit code",
+                                info="file expected, but missing: {file:s}".format(
+                                    file=out_filename
+                                ),
                             )
-                            report.errors.add(clean_stderr)
+                            test_result.attach_output(
+                                "output file missing: {file:s}".format(
+                                    file=out_filename
+                                ),
+                                "",
+                            )
+
+                    if (exit_code != 0 and not stopped) or len(stderr) > 0:
+                        clean_stderr = error_cleanup(stderr)
+                        test_result.attach_output(
+                            "runtime errors (exit code: {x:s})".format(
+                                x=str(exit_code)
+                            ),
+                            clean_stderr,
+                        )
+                        test_result.set_score(
+                            score=0.0,
+                            info="runtime errors or nonstandard exit code",
+                        )
+                        errors.add(clean_stderr)
                 except GraderException as e:
                     raise e
                 except Exception:
@@ -634,8 +2722,152 @@ def test_one(folder, srcpath=None, config=None, style=None, quiet=False):
                         )
                     )
 
-                report.add_result(test_result)
-                yield test_result
+            finally:
+                with PhaseTimer.measure("workspace"):
+                    pool.release(workspace)
+
+            return test_result
+
+        # a suite can be shared by several programs graded against it
+        shared = suite is not None
+        if not shared:
+            suite = TestSuite(folder, config)
+        report.tests = len(suite.cases)
+
+        jobs = min(
+            options.jobs,
+            config.getint("grader-config", "jobs", fallback=options.jobs),
+        )
+        max_failures = config.getint(
+            "grader-config", "max-failures", fallback=options.max_failures or 0
+        )
+
+        history = None
+        if options.order == "history":
+            history = TestHistory.get_default()
+
+        cache = ResultCache() if options.cache else None
+        if cache is not None:
+            cache_key = cache.make_key(
+                folder, srcpath, runner, stop_on_mismatch, max_failures, options.order
+            )
+            cached = cache.load(cache_key, report)
+            if cached is not None:
+                for result in cached:
+                    set_limits(result)
+                    report.add_result(result)
+                    yield await finish(result)
+                if history is not None:
+                    history.record(srcpath, report)
+                return
+
+        cases = suite.cases
+        if history is not None:
+            cases = history.order(srcpath, cases, parallel=jobs > 1)
+
+        try:
+            with tempfile.TemporaryDirectory() as workspaces:
+                pool = WorkspacePool(workspaces, source, srcpath)
+                codefile = None
+                if not warned:
+                    codefile = os.path.join(workspaces, "program.code")
+                    with open(codefile, "wb") as f:
+                        marshal.dump(code, f)
+                async for result in _run_ordered(
+                    run_case,
+                    cases,
+                    report,
+                    jobs=jobs,
+                    max_failures=max_failures,
+                    gate=gate,
+                ):
+                    yield await finish(result)
+        finally:
+            if not shared:
+                suite.close()
+
+        if history is not None:
+            history.record(srcpath, report)
+        if cache is not None:
+            cache.store(cache_key, report)
+
+
+async def _run_ordered(run_case, cases, report, jobs=1, max_failures=0, gate=None):
+    # every case is started right away, but at most `jobs` of them hold a
+    # process at once; results are handed back in test order. once
+    # `max_failures` cases have failed, the ones not yet started are skipped.
+    # a shared `gate` additionally limits processes across several programs
+    local = asyncio.Semaphore(jobs)
+    failures = 0
+
+    async def run_one(case):
+        nonlocal failures
+        skip = 0 < max_failures <= failures
+        result = await run_case(case, skip=skip)
+        if not skip and not result.is_passing():
+            failures += 1
+        return result
+
+    async def run_gated(case):
+        async with local:
+            if gate is None:
+                return await run_one(case)
+            async with gate:
+                return await run_one(case)
+
+    tasks = [asyncio.ensure_future(run_gated(case)) for case in cases]
+    try:
+        for task in tasks:
+            result = await task
+            report.add_result(result)
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _iterate_async(agen):
+    # run an async generator on an event loop thread of its own, so the loop
+    # keeps servicing running tests while the caller handles each item
+    items = queue.Queue()
+    loop = asyncio.new_event_loop()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put((True, item))
+            items.put((False, None))
+        except Exception as e:
+            items.put((False, e))
+
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            with contextlib.suppress(asyncio.CancelledError):
+                loop.run_until_complete(task)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            items.put((False, None))
+            loop.close()
+
+    task = loop.create_task(pump())
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    try:
+        while True:
+            with contextlib.suppress(queue.Empty):
+                more, item = items.get(timeout=0.1)
+                if not more:
+                    if item is not None:
+                        raise item
+                    return
+                yield item
+    finally:
+        with contextlib.suppress(RuntimeError):  # loop may already be closed
+            loop.call_soon_threadsafe(task.cancel)
+        worker.join()
 
 
 def _get_report(results):
@@ -673,9 +2905,25 @@ def _get_tests_from_folder(tests_folder):
     return tests
 
 
-def test_all(zippath):
+def _find_in_zip(name, path):
+    for x in path.iterdir():
+        if x.name == name:
+            return path
+        elif x.is_dir() and x.name != "__MACOSX" and x.name != ".DS_Store":
+            p = _find_in_zip(name, x)
+            if p is not None:
+                return p
+    return None
+
+
+def test_all(zippath, options=None):
+    yield from _iterate_async(test_all_async(zippath, options=options))
+
+
+async def test_all_async(zippath, options=None):
     import os.path
 
+    calibration = Calibration.load(zippath)
     os.chdir(os.path.dirname(os.path.abspath(zippath)))
 
     def log_error(source):
@@ -708,47 +2956,45 @@ def test_all(zippath):
 
     if not os.path.exists(zippath):
         write_error("Cannot find test zip.")
-        return False
+        return
     elif not zipfile.is_zipfile(zippath):
         write_error("Test zip is malformed.")
         write_error(
             "Redownload the test zip and try again. If problems persist, notify your instructor."
         )
-        return False
+        return
 
     codechecker = None
     count_tests = 0
 
     reports = set()
     with zipfile.ZipFile(zippath, "r") as testzip:
-
-        def find_in_zip(name, path):
-            for x in path.iterdir():
-                if x.name == name:
-                    return path
-                elif x.is_dir() and x.name != "__MACOSX" and x.name != ".DS_Store":
-                    p = find_in_zip(name, x)
-                    if p is not None:
-                        return p
-            return None
-
-        tests_folder = find_in_zip("pycodestyle.py", zipfile.Path(testzip))
-        codechecker = load_pycodestyle(tests_folder / "pycodestyle.py")
+        tests_folder = _find_in_zip("pycodestyle.py", zipfile.Path(testzip))
+        cache = ResultCache() if options is None or options.cache else None
+        codechecker = load_pycodestyle(tests_folder / "pycodestyle.py", cache=cache)
 
         test_set = _get_tests_from_folder(tests_folder)
         if not test_set:
             print("No tests found in zip folder {zip:s}?".format(zip=zippath))
-            return []
+            return
 
         for folder, config in test_set:
             source = config.get("grader-config", "source")
             try:
-                style_errors = []
+                style = None
                 if codechecker and os.path.exists(source):
-                    style_report = codechecker.check_files([source])
-                    style_errors = style_report.get_messages()
+                    style = asyncio.get_running_loop().run_in_executor(
+                        None, codechecker.check, source, cache
+                    )
 
-                yield from test_one(folder, config=config, style=style_errors)
+                async for result in test_one_async(
+                    folder,
+                    config=config,
+                    style=style,
+                    options=options,
+                    calibration=calibration,
+                ):
+                    yield result
             except GraderException as e:
                 write_error("")
                 write_error("<Grader Error> " + str(e))
@@ -761,6 +3007,444 @@ def test_all(zippath):
                 )
 
 
+def _find_submissions(path):
+    # every folder or zip in the submissions folder is one student's work
+    submissions = []
+    for entry in sorted(os.scandir(path), key=lambda x: x.name):
+        if entry.is_dir():
+            submissions.append((entry.name, entry.path))
+        elif zipfile.is_zipfile(entry.path):
+            submissions.append((os.path.splitext(entry.name)[0], entry.path))
+    return submissions
+
+
+def _find_source(root, source):
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(x for x in dirs if x != "__MACOSX")
+        if source in files:
+            return os.path.join(folder, source)
+    return os.path.join(root, source)
+
+
+def test_batch(zippath, submissions, options=None, output=BATCH_RESULTS, writer=None):
+    return asyncio.run(
+        test_batch_async(
+            zippath, submissions, options=options, output=output, writer=writer
+        )
+    )
+
+
+async def test_batch_async(
+    zippath, submissions, options=None, output=BATCH_RESULTS, writer=None
+):
+    # the test zip, its manifests and the style checker are loaded once and
+    # shared by every submission; all of their test cases draw from one pool
+    # of `jobs` processes. submissions are graded from temporary copies, so
+    # there is no history to order their tests by, or to keep
+    options = options or GraderOptions()
+    options = GraderOptions(
+        jobs=options.jobs,
+        runner=options.runner,
+        stop_on_mismatch=options.stop_on_mismatch,
+        max_failures=options.max_failures,
+        cache=options.cache,
+        order="fixed",
+    )
+    if not zipfile.is_zipfile(zippath):
+        write_error("Test zip is malformed.")
+        return False
+
+    with contextlib.ExitStack() as stack:
+        testzip = stack.enter_context(zipfile.ZipFile(zippath, "r"))
+        unpacked = stack.enter_context(tempfile.TemporaryDirectory())
+
+        tests_folder = _find_in_zip("pycodestyle.py", zipfile.Path(testzip))
+        if tests_folder is None:
+            write_error("No tests found in zip folder {zip:s}?".format(zip=zippath))
+            return False
+        cache = ResultCache() if options.cache else None
+        codechecker = load_pycodestyle(tests_folder / "pycodestyle.py", cache=cache)
+
+        suites = []
+        for folder, config in _get_tests_from_folder(tests_folder):
+            suite = TestSuite(folder, config)
+            stack.callback(suite.close)
+            suites.append(suite)
+
+        gate = asyncio.Semaphore(options.jobs)
+        calibration = Calibration.load(zippath)
+
+        async def grade_program(student, suite, root):
+            source = suite.config.get("grader-config", "source")
+            name = "{student:s}/{source:s}".format(student=student, source=source)
+            srcpath = _find_source(root, source)
+            try:
+                style = None
+                if codechecker and os.path.exists(srcpath):
+                    style = asyncio.get_running_loop().run_in_executor(
+                        None, codechecker.check, srcpath, cache
+                    )
+
+                report = None
+                async for result in test_one_async(
+                    suite.folder,
+                    srcpath=srcpath,
+                    config=suite.config,
+                    style=style,
+                    quiet=True,
+                    options=options,
+                    suite=suite,
+                    gate=gate,
+                    calibration=calibration,
+                ):
+                    if writer is not None:
+                        writer.add(result, suite=name)
+                    report = result.report
+                return report or GraderReport(source)
+            except GraderException as e:
+                report = GraderReport(source, error=str(e))
+                if writer is not None:
+                    writer.add(report.make_error(), suite=name)
+                return report
+
+        async def grade_submission(student, path):
+            root = path
+            if not os.path.isdir(path):
+                root = tempfile.mkdtemp(dir=unpacked)
+                with zipfile.ZipFile(path) as subzip:
+                    subzip.extractall(root)
+            reports = await asyncio.gather(
+                *(grade_program(student, suite, root) for suite in suites)
+            )
+            passed = sum(x.count_passed() for x in reports)
+            tests = sum(x.tests or 0 for x in reports)
+            print(
+                "{student:s}: {passed:d}/{tests:d} tests passed".format(
+                    student=student, passed=passed, tests=tests
+                )
+            )
+            return student, reports
+
+        start = time.perf_counter()
+        graded = await asyncio.gather(
+            *(grade_submission(*x) for x in _find_submissions(submissions))
+        )
+        elapsed = time.perf_counter() - start
+
+    count = 0
+    with open(output, "w") as f:
+        # one submission at a time, so only its output is read back at once
+        f.write('{\n "tests": ' + json.dumps(zippath) + ',\n "submissions": {')
+        for n, (student, reports) in enumerate(graded):
+            programs = {}
+            for report in reports:
+                count += len(report.results)
+                programs[report.source] = {
+                    "grade": report.get_grade(),
+                    "passed": report.count_passed(),
+                    "tests": report.tests,
+                    "errors": sorted(report.errors),
+                    "style_errors": report.style_errors,
+                    "results": [x.to_dict() for x in report.results],
+                }
+            f.write(",\n  " if n else "\n  ")
+            f.write(json.dumps(student) + ": " + json.dumps(programs))
+        f.write("\n }\n}\n")
+
+    print(
+        "Graded {n:d} tests from {s:d} submissions in {t:.2f}s ({r:.1f} tests/second)".format(
+            n=count, s=len(graded), t=elapsed, r=count / elapsed if elapsed else 0.0
+        )
+    )
+    print("Results written to {output:s}".format(output=output))
+    return True
+
+
+def calibrate(zippath, reference=None, options=None):
+    # measure this machine, and with a reference solution its runtime for
+    # every test; tests run one at a time so they don't slow each other down
+    options = options or GraderOptions()
+    options = GraderOptions(runner=options.runner, jobs=1, cache=False, order="fixed")
+    calibration = Calibration(_cpu_benchmark(), digest=Calibration.get_digest(zippath))
+    print("Benchmark: {:.3f} sec".format(calibration.benchmark))
+
+    if reference is not None:
+        with zipfile.ZipFile(zippath, "r") as testzip:
+            tests_folder = _find_in_zip("pycodestyle.py", zipfile.Path(testzip))
+            if tests_folder is None:
+                write_error("No tests found in zip folder {zip:s}?".format(zip=zippath))
+                return False
+            for folder, config in _get_tests_from_folder(tests_folder):
+                source = config.get("grader-config", "source")
+                srcpath = _find_source(reference, source)
+                baselines = calibration.baselines[source] = {}
+                for result in test_one(
+                    folder, srcpath=srcpath, config=config, quiet=True, options=options
+                ):
+                    print_report_progress(result.report, result.index + 1)
+                    if result.id == GraderTestResult.ERROR_ID:
+                        write_error("Missing reference solution: " + srcpath)
+                    elif not result.is_passing():
+                        write_error(
+                            "Reference solution failed {name:s}".format(
+                                name=result.get_name()
+                            )
+                        )
+                    else:
+                        baselines[result.id] = result.runtime
+                print("")
+
+    print("Calibration written to", calibration.save(zippath))
+    return True
+
+
+def watch(zippath, options=None):
+    with contextlib.suppress(KeyboardInterrupt):
+        return asyncio.run(watch_async(zippath, options=options))
+    print("")
+    print("Stopped watching.")
+    return True
+
+
+async def watch_async(zippath, options=None):
+    # the test zip, the style checker and the forked runners stay loaded, and a
+    # program is graded again whenever its source file changes
+    options = options or GraderOptions()
+    if not zipfile.is_zipfile(zippath):
+        write_error("Test zip is malformed.")
+        return False
+
+    zippath = os.path.abspath(zippath)
+    calibration = Calibration.load(zippath)
+    os.chdir(os.path.dirname(zippath))
+
+    with contextlib.ExitStack() as stack:
+        testzip = stack.enter_context(zipfile.ZipFile(zippath, "r"))
+        tests_folder = _find_in_zip("pycodestyle.py", zipfile.Path(testzip))
+        if tests_folder is None:
+            write_error("No tests found in zip folder {zip:s}?".format(zip=zippath))
+            return False
+        cache = ResultCache() if options.cache else None
+        codechecker = load_pycodestyle(tests_folder / "pycodestyle.py", cache=cache)
+
+        suites = []
+        for folder, config in _get_tests_from_folder(tests_folder):
+            suite = TestSuite(folder, config)
+            stack.callback(suite.close)
+            suites.append(suite)
+        if not suites:
+            print("No tests found in zip folder {zip:s}?".format(zip=zippath))
+            return False
+
+        def get_stamp(source):
+            with contextlib.suppress(OSError):
+                stat = os.stat(source)
+                return stat.st_mtime_ns, stat.st_size
+            return None
+
+        async def grade(n):
+            suite = suites[n]
+            source = suite.config.get("grader-config", "source")
+            style = None
+            if codechecker and os.path.exists(source):
+                style = asyncio.get_running_loop().run_in_executor(
+                    None, codechecker.check, source, cache
+                )
+
+            start, report = time.perf_counter(), None
+            try:
+                async for result in test_one_async(
+                    suite.folder,
+                    config=suite.config,
+                    style=style,
+                    options=options,
+                    suite=suite,
+                    calibration=calibration,
+                ):
+                    report = result.report
+                    if result.id != GraderTestResult.ERROR_ID:
+                        print_report_progress(report, result.index + 1)
+            except GraderException as e:
+                write_error("")
+                write_error("<Grader Error> " + str(e))
+                return
+            if report is None or not report.tests:
+                return
+
+            print("")
+            print(
+                "{src:s}: {passed:d}/{tests:d} tests passed in {t:.2f}s".format(
+                    src=source,
+                    passed=report.count_passed(),
+                    tests=report.tests,
+                    t=time.perf_counter() - start,
+                )
+            )
+            for result in report.results:
+                if not result.is_passing():
+                    print(
+                        "- {id:s}: {info:s}".format(
+                            id=result.id, info=result.info or "too slow"
+                        )
+                    )
+            if report.style_errors:
+                print("- {n:d} style errors".format(n=len(report.style_errors)))
+
+        stamps = [get_stamp(x.config.get("grader-config", "source")) for x in suites]
+        for n in range(len(suites)):
+            await grade(n)
+
+        print("")
+        print("Watching for changes (Ctrl+C to stop)...")
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for n, suite in enumerate(suites):
+                source = suite.config.get("grader-config", "source")
+                stamp = get_stamp(source)
+                if stamp != stamps[n]:
+                    stamps[n] = stamp
+                    print("")
+                    print("{src:s} changed".format(src=source))
+                    await grade(n)
+
+
+def bench(root, options=None, save=None, compare=None):
+    # grade every bundled test zip against its reference solution (the folder
+    # named after the zip) and show where the time goes
+    options = options or GraderOptions()
+    options = GraderOptions(
+        jobs=options.jobs, runner=options.runner, cache=False, order="fixed"
+    )
+    timer = PhaseTimer.active = PhaseTimer()
+
+    zips = {}
+    start = time.perf_counter()
+    for zippath in sorted(glob.glob(os.path.join(root, "graderzips", "tests-*.zip"))):
+        name = os.path.basename(zippath)[len("tests-") : -len(".zip")]
+        reference = os.path.join(root, name)
+        if not os.path.isdir(reference):
+            write_error("No reference solution for {zip:s}".format(zip=zippath))
+            continue
+
+        zip_start = time.perf_counter()
+        tests, passed = asyncio.run(_bench_zip(zippath, reference, options))
+        zips[name] = {
+            "tests": tests,
+            "passed": passed,
+            "wall": time.perf_counter() - zip_start,
+        }
+        print(
+            "{name:s}: {passed:d}/{tests:d} tests passed in {t:.2f}s".format(
+                name=name, passed=passed, tests=tests, t=zips[name]["wall"]
+            )
+        )
+    wall = time.perf_counter() - start
+    PhaseTimer.active = None
+
+    tests = sum(x["tests"] for x in zips.values())
+    results = {
+        "grader_version": GRADER_VERSION,
+        "python": sys.version.split()[0],
+        "runner": options.runner,
+        "jobs": options.jobs,
+        "tests": tests,
+        "wall": wall,
+        "tests_per_second": tests / wall if wall else 0.0,
+        "phases": timer.totals,
+        "zips": zips,
+    }
+
+    baseline = None
+    if compare is not None:
+        with open(compare, "r") as f:
+            baseline = json.load(f)
+
+    def per_test(data, phase):
+        seconds = data["phases"].get(phase)
+        if seconds is None or not data["tests"]:
+            return None
+        return 1000 * seconds / data["tests"]
+
+    print("")
+    header = "{:<10s} {:>9s} {:>12s}".format("phase", "seconds", "ms per test")
+    print(header + ("  baseline" if baseline else ""))
+    for phase, seconds in timer.totals.items():
+        line = "{:<10s} {:9.3f} {:12.3f}".format(
+            phase, seconds, per_test(results, phase) or 0.0
+        )
+        old = per_test(baseline, phase) if baseline else None
+        if old:
+            line += "  {:8.3f} ({:+.0f}%)".format(
+                old, 100 * ((per_test(results, phase) or 0.0) / old - 1)
+            )
+        print(line)
+    line = "{n:d} tests in {t:.2f}s ({r:.1f} tests/second)".format(
+        n=tests, t=wall, r=results["tests_per_second"]
+    )
+    if baseline and baseline.get("tests_per_second"):
+        line += ", baseline {r:.1f} tests/second ({d:+.0f}%)".format(
+            r=baseline["tests_per_second"],
+            d=100 * (results["tests_per_second"] / baseline["tests_per_second"] - 1),
+        )
+    print(line)
+
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Timings written to {output:s}".format(output=save))
+    return True
+
+
+async def _bench_zip(zippath, reference, options):
+    tests = passed = 0
+    with contextlib.ExitStack() as stack:
+        with PhaseTimer.measure("zip"):
+            testzip = stack.enter_context(zipfile.ZipFile(zippath, "r"))
+            tests_folder = _find_in_zip("pycodestyle.py", zipfile.Path(testzip))
+            if tests_folder is None:
+                write_error("No tests found in zip folder {zip:s}?".format(zip=zippath))
+                return tests, passed
+            suites = []
+            for folder, config in _get_tests_from_folder(tests_folder):
+                suite = TestSuite(folder, config)
+                stack.callback(suite.close)
+                suites.append(suite)
+        with PhaseTimer.measure("style"):
+            codechecker = load_pycodestyle(tests_folder / "pycodestyle.py")
+
+        for suite in suites:
+            source = suite.config.get("grader-config", "source")
+            srcpath = _find_source(reference, source)
+            style = None
+            if codechecker and os.path.exists(srcpath):
+                with PhaseTimer.measure("style"):
+                    style = codechecker.check(srcpath)
+
+            try:
+                async for result in test_one_async(
+                    suite.folder,
+                    srcpath=srcpath,
+                    config=suite.config,
+                    style=style,
+                    quiet=True,
+                    options=options,
+                    suite=suite,
+                ):
+                    if result.id == GraderTestResult.ERROR_ID:
+                        continue
+                    with PhaseTimer.measure("feedback"):
+                        for _ in result.get_output():
+                            pass
+                    tests += 1
+                    passed += 1 if result.is_passing() else 0
+            except Exception as e:
+                # e.g. a custom grader written for an older grader
+                write_error(
+                    "<Grader Error> {src:s}: {e:s}".format(src=srcpath, e=str(e))
+                )
+    return tests, passed
+
+
 def make_submission_zip(testzip, sources):
     base = os.path.basename(testzip)
     output = base.split("-", 1)[-1] if base.startswith("tests-") else "submit.zip"
@@ -781,17 +3465,22 @@ def make_submission_zip(testzip, sources):
     return output
 
 
-def test_via_console(testzip=None):
+def test_via_console(testzip=None, options=None, writer=None):
     passing, reports = True, set()
     with open("feedback.txt", "w") as feedback:
-        for result in test_all(testzip):
-            print_report_progress(result.report, result.index)
+        for result in test_all(testzip, options=options):
+            if writer is not None:
+                writer.add(result)
+            # a program that couldn't be tested has no progress to show
+            if result.report.tests:
+                print_report_progress(result.report, result.index)
             passing = passing and result.is_passing()
             for line in result.get_output():
                 feedback.write(line)
             if result.report.is_complete():
-                print_report_progress(result.report, result.report.tests)
-                print("")
+                if result.report.tests:
+                    print_report_progress(result.report, result.report.tests)
+                    print("")
                 reports.add(result.report)
 
     if passing:
@@ -801,11 +3490,19 @@ def test_via_console(testzip=None):
         print("The following programs did not pass:")
         for report in reports:
             if not report.is_passing():
-                print("-", report.source)
+                skipped = report.count_skipped()
+                if skipped:
+                    print(
+                        "- {src:s} ({n:d} tests skipped after failures)".format(
+                            src=report.source, n=skipped
+                        )
+                    )
+                else:
+                    print("-", report.source)
     return False
 
 
-def test_fallback(testzip=None):
+def test_fallback(testzip=None, options=None):
     if testzip is None:
         zips = glob.glob("tests-*.zip")
         if len(zips) == 0:
@@ -820,24 +3517,48 @@ def test_fallback(testzip=None):
             testzip = zips[x]
 
     print("Using", testzip)
-    return test_via_console(testzip)
+    return test_via_console(testzip, options=options)
 
 
-def _run_tests(zippath, q):
-    def _send_progress(report, x):
-        message = "[{x:d}/{r.tests:d}] Grading {r.source:s}".format(x=x, r=report)
-        bar_value = round(100 * x / report.tests)
-        q.put(("progress", (message, bar_value)))
+def _run_tests(zippath, q, options=None, spool=None):
+    # output is written to the GUI's spool, through a file of our own
+    if spool is not None:
+        OutputSpool.default = OutputSpool(spool)
+
+    # results go out in batches, without their output (the GUI reads that
+    # from the spool) and with a copy of the report that has no results
+    batch, progress, detached = [], None, {}
+    last_sent = time.monotonic()
+
+    def _send_batch():
+        nonlocal batch, progress, last_sent
+        if batch:
+            q.put(("results", batch))
+        if progress is not None:
+            q.put(("progress", progress))
+        batch, progress, last_sent = [], None, time.monotonic()
 
     passing, sources = True, set()
-    for result in test_all(zippath):
+    for result in test_all(zippath, options=options):
+        report = result.report
         if result.id != GraderTestResult.ERROR_ID:
-            _send_progress(result.report, result.index)
-            q.put(("result", result))
+            if report.source not in detached:
+                detached[report.source] = report.detach()
+            batch.append(result.detach(detached[report.source]))
+            progress = (
+                "[{x:d}/{r.tests:d}] Grading {r.source:s}".format(
+                    x=result.index, r=report
+                ),
+                round(100 * result.index / report.tests),
+            )
         passing = passing and result.is_passing()
-        if result.report.is_complete():
-            q.put(("report", result.report))
-            sources.add(result.report.source)
+        if report.tests is None or result.index + 1 >= report.tests:
+            _send_batch()
+            q.put(("report", report.detach()))
+            sources.add(report.source)
+        elif time.monotonic() - last_sent >= GUI_BATCH_INTERVAL:
+            _send_batch()
+    _send_batch()
 
     output = make_submission_zip(zippath, sources) if passing else None
     last = (
@@ -848,7 +3569,7 @@ def _run_tests(zippath, q):
     q.put((None, (last, 100)))
 
 
-def test_via_gui(testzip=None, autorun=False):
+def test_via_gui(testzip=None, autorun=False, options=None):
     try:
         import tkinter as tk
         from tkinter import ttk
@@ -856,7 +3577,7 @@ def test_via_gui(testzip=None, autorun=False):
         from tkinter import filedialog, scrolledtext
     except ImportError as e:
         print("Could not import GUI libraries ({e.name:s})...".format(e=e))
-        return test_fallback(testzip)
+        return test_fallback(testzip, options=options)
 
     TYPE_ZIP = [("Archive (ZIP)", "*.zip")]
     TYPE_PY = [("Python scripts", "*.py")]
@@ -876,6 +3597,9 @@ def test_via_gui(testzip=None, autorun=False):
 
     results_dict = dict()
     reports_dict = dict()
+    report_copies = dict()
+    source_lines = dict()
+    view_lines, page_pending = None, False
 
     if testzip:
         path = pathlib.PureWindowsPath(os.path.abspath(testzip)).as_posix()
@@ -926,70 +3650,115 @@ def test_via_gui(testzip=None, autorun=False):
     task_list.heading("test", text="Test Name")
     task_list.column("test", minwidth=200, width=200, stretch=False)
     task_list.heading("runtime", text="Runtime")
-    task_list.column("runtime", minwidth=80, width=80, stretch=False)
+    task_list.column("runtime", minwidth=80, width=220, stretch=False)
 
     PASS_ICON = tk.PhotoImage(data=PASS_GIF, format="gif")
     FAIL_ICON = tk.PhotoImage(data=FAIL_GIF, format="gif")
     INFO_ICON = tk.PhotoImage(data=INFO_GIF, format="gif")
 
-    def _add_style_errors(report):
-        if report.style_errors:
-            label = "<style errors ({count:d})>\n".format(
-                count=len(report.style_errors)
-            )
-            text_area.insert("end", label, ("header",))
-            with open(report.source, "r") as f:
-                source_lines = f.readlines()
-
-            for line in report.style_errors:
-                text_area.insert("end", line + "\n", ("infoline",))
-                line_num, col_num = (int(x) for x in line.split(":")[1:3])
-                text_area.insert("end", source_lines[line_num - 1])
-                for ch in source_lines[line_num - 1][: (col_num - 1)]:
-                    text_area.insert("end", ch if ch.isspace() else " ")
-                text_area.insert("end", "^\n")
+    def _style_lines(report):
+        if not report.style_errors:
+            return
+        label = "<style errors ({count:d})>".format(count=len(report.style_errors))
+        yield label, "header", None, ()
 
-    def _load_result(result):
-        text_area.configure(state=tk.NORMAL)
-        text_area.delete("1.0", tk.END)
+        if report.source not in source_lines:
+            with open(report.source, "r") as f:
+                source_lines[report.source] = f.read().splitlines()
+        lines = source_lines[report.source]
+
+        for line in report.style_errors:
+            yield line, "infoline", None, ()
+            line_num, col_num = (int(x) for x in line.split(":")[1:3])
+            source_line = lines[line_num - 1]
+            yield source_line, None, None, ()
+            indent = "".join(
+                ch if ch.isspace() else " " for ch in source_line[: (col_num - 1)]
+            )
+            yield indent + "^", None, None, ()
 
-        line_number, highlight = 0, None
-        for line in result.get_output():
+    def _output_lines(output):
+        # a "? " line only marks the changed characters of the line before it
+        last = None
+        for line in output:
             pre, msg = line[:2], line[2:]
             if pre == "? ":
-                x = None
-                for i, ch in enumerate(msg + " "):
-                    if x is None and not ch.isspace():
-                        x = i
-                    elif x is not None and ch.isspace():
-                        text_area.tag_add(
-                            highlight,
-                            "{:d}.{:d}".format(line_number, x),
-                            "{:d}.{:d}".format(line_number, i),
-                        )
-                        x = None
-            else:
-                this_style, highlight = tag_map[pre]
-                text_area.insert("end", msg + "\n", (this_style,))
-                line_number += 1
-        _add_style_errors(result.report)
-        text_area.configure(state=tk.DISABLED)
-
-    def _load_report(report):
-        text_area.configure(state=tk.NORMAL)
-        text_area.delete("1.0", tk.END)
+                if last is not None and last[2] is not None:
+                    last[3].extend(m.span() for m in re.finditer(r"\S+", msg))
+                continue
+            if last is not None:
+                yield last
+            this_style, highlight = tag_map[pre]
+            last = (msg, this_style, highlight, [])
+        if last is not None:
+            yield last
+
+    def _error_lines(report):
         if report.errors:
-            header = "<syntax and runtime errors ({count:d})>\n".format(
+            header = "<syntax and runtime errors ({count:d})>".format(
                 count=len(report.errors)
             )
-            text_area.insert("end", header, ("header",))
-
+            yield header, "header", None, ()
             for error in report.errors:
-                text_area.insert("end", error, ("infoline",))
-                text_area.insert("end", "\n")
+                yield error.rstrip("\n"), "infoline", None, ()
+                yield "", None, None, ()
 
-        _add_style_errors(report)
+    def _show(lines):
+        # lines are added a page at a time, as the view is scrolled down to them
+        nonlocal view_lines
+        view_lines = lines
+        text_area.configure(state=tk.NORMAL)
+        text_area.delete("1.0", tk.END)
         text_area.configure(state=tk.DISABLED)
+        _add_page()
+
+    def _add_page():
+        nonlocal view_lines, page_pending
+        page_pending = False
+        if view_lines is None:
+            return
+
+        line_number = int(text_area.index("end-1c").split(".")[0])
+        chunks, ranges = [], {}
+        for msg, this_style, highlight, spans in itertools.islice(
+            view_lines, GUI_PAGE_LINES
+        ):
+            chunks += [msg + "\n", (this_style,) if this_style else ()]
+            for x, y in spans:
+                ranges.setdefault(highlight, []).extend(
+                    (
+                        "{:d}.{:d}".format(line_number, x),
+                        "{:d}.{:d}".format(line_number, y),
+                    )
+                )
+            line_number += 1
+        if len(chunks) < 2 * GUI_PAGE_LINES:
+            view_lines = None
+        if not chunks:
+            return
+
+        # one insert and one tag_add per tag for the whole page
+        text_area.configure(state=tk.NORMAL)
+        text_area.insert("end", *chunks)
+        for highlight, indices in ranges.items():
+            text_area.tag_add(highlight, *indices)
+        text_area.configure(state=tk.DISABLED)
+
+    def _text_scrolled(first, last):
+        nonlocal page_pending
+        text_area.vbar.set(first, last)
+        if view_lines is not None and not page_pending and float(last) >= 0.9:
+            page_pending = True
+            text_area.after_idle(_add_page)
+
+    text_area.configure(yscrollcommand=_text_scrolled)
+
+    def _load_result(result):
+        report = report_copies.get(result.report.source, result.report)
+        _show(itertools.chain(_output_lines(result.get_output()), _style_lines(report)))
+
+    def _load_report(report):
+        _show(itertools.chain(_error_lines(report), _style_lines(report)))
 
     def _task_select(event):
         for selected_item in task_list.selection():
@@ -1017,40 +3786,57 @@ def test_via_gui(testzip=None, autorun=False):
     def work_loop():
         def _handle_result(result):
             if result.get_name() in results_dict:
-                return
+                return None
             status = PASS_ICON if result.is_passing() else FAIL_ICON
-            task_list.insert(
-                "",
-                tk.END,
-                image=status,
-                values=(result.get_name(), "{:.2f} sec".format(result.runtime)),
-            )
+            runtime = "{:.2f} sec".format(result.runtime)
+            if result.cpu_time is not None and result.max_rss is not None:
+                runtime += " (cpu {:.2f} sec, {:.0f} MB)".format(
+                    result.cpu_time, result.max_rss / (1024 * 1024)
+                )
+            elif result.cpu_time is not None:
+                runtime += " (cpu {:.2f} sec)".format(result.cpu_time)
+            if result.skipped:
+                status, runtime = INFO_ICON, "skipped"
             results_dict[result.get_name()] = result
-            task_list.yview(tk.MOVETO, 1.0)
+            return status, (result.get_name(), runtime)
 
         def _add_report_notes(report):
+            # the final copy of the report has the style errors
+            report_copies[report.source] = report
             if report.has_errors():
                 name = "{source:s}/errors".format(source=report.source)
-                task_list.insert("", tk.END, image=INFO_ICON, values=(name, "---"))
                 reports_dict[name] = report
-                task_list.yview(tk.MOVETO, 1.0)
+                return INFO_ICON, (name, "---")
+            return None
 
         nonlocal p
-        while not q.empty():
-            type, data = q.get_nowait()
+        rows, done = [], None
+        while done is None:
+            try:
+                type, data = q.get_nowait()
+            except queue.Empty:
+                break
             if type == "progress":
                 set_progress(*data)
+            elif type == "results":
+                rows += [_handle_result(result) for result in data]
             elif type == "report":
-                for result in data.results:
-                    _handle_result(result)
-                _add_report_notes(data)
-            elif type == "result":
-                _handle_result(data)
+                rows.append(_add_report_notes(data))
             else:
-                p = None
-                set_progress(*data)
-                return
-        window.after(50, work_loop)
+                done = data
+
+        # one scroll for the whole batch
+        for row in rows:
+            if row is not None:
+                task_list.insert("", tk.END, image=row[0], values=row[1])
+        if any(rows):
+            task_list.yview(tk.MOVETO, 1.0)
+
+        if done is not None:
+            p = None
+            set_progress(*done)
+            return
+        window.after(GUI_REFRESH, work_loop)
 
     def select_file(types, var):
         def _f():
@@ -1073,15 +3859,19 @@ def test_via_gui(testzip=None, autorun=False):
             return
 
         results_dict.clear()
+        reports_dict.clear()
+        report_copies.clear()
+        source_lines.clear()
         for item in task_list.get_children():
             task_list.delete(item)
 
-        text_area.configure(state=tk.NORMAL)
-        text_area.delete("1.0", tk.END)
-        text_area.configure(state=tk.DISABLED)
+        _show(None)
 
         work_loop()
-        p = multiprocessing.Process(target=_run_tests, args=(zippath, q))
+        spool = OutputSpool.get_default().path
+        p = multiprocessing.Process(
+            target=_run_tests, args=(zippath, q, options, spool)
+        )
         p.start()
 
     menu = tk.Menu(window)
@@ -1109,8 +3899,189 @@ def test_via_gui(testzip=None, autorun=False):
         p.kill()
 
 
+def _add_options(parser):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help="number of test cases to run at once (default: {:d})".format(DEFAULT_JOBS),
+    )
+    parser.add_argument(
+        "--runner",
+        choices=RUNNERS,
+        default=DEFAULT_RUNNER,
+        help="how programs are started: forked from a warm interpreter, "
+        + "or a fresh interpreter per test (default: {:s})".format(DEFAULT_RUNNER),
+    )
+    parser.add_argument(
+        "--stop-on-mismatch",
+        action="store_true",
+        help="stop a program as soon as its console output differs from the expected output",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_const",
+        const=1,
+        dest="max_failures",
+        help="skip the rest of a program's tests after the first one fails",
+    )
+    parser.add_argument(
+        "--max-failures",
+        metavar="K",
+        type=int,
+        dest="max_failures",
+        help="skip the rest of a program's tests after K of them fail",
+    )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        default=DEFAULT_ORDER,
+        help="start with the tests that failed last time (and the longest ones "
+        + "when running several at once), or keep the order of the test zip "
+        + "(default: {:s})".format(DEFAULT_ORDER),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        dest="cache",
+        help="always rerun tests instead of reusing results from {:s}".format(
+            CACHE_DIR
+        ),
+    )
+    parser.add_argument(
+        "--jsonl", metavar="FILE", help="also write results as JSON Lines to FILE"
+    )
+    parser.add_argument(
+        "--junit", metavar="FILE", help="also write results as JUnit XML to FILE"
+    )
+
+
+def _get_options(args):
+    return GraderOptions(
+        jobs=args.jobs,
+        runner=args.runner,
+        stop_on_mismatch=args.stop_on_mismatch,
+        max_failures=args.max_failures,
+        cache=args.cache,
+        order=args.order,
+    )
+
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="grader.py batch",
+        description="Grade a folder of submissions against a test zip.",
+    )
+    parser.add_argument("testzip", help="path to the test zip")
+    parser.add_argument(
+        "submissions", help="folder holding one zip or folder per submission"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=BATCH_RESULTS,
+        help="where to write the results (default: {:s})".format(BATCH_RESULTS),
+    )
+    _add_options(parser)
+    args = parser.parse_args(argv)
+    with ResultWriter(jsonl=args.jsonl, junit=args.junit) as writer:
+        return test_batch(
+            args.testzip,
+            args.submissions,
+            options=_get_options(args),
+            output=args.output,
+            writer=writer,
+        )
+
+
+def main_calibrate(argv):
+    parser = argparse.ArgumentParser(
+        prog="grader.py calibrate",
+        description="Measure this machine (and optionally a reference solution) "
+        + "so that timeouts can be scaled to the machine grading runs on.",
+    )
+    parser.add_argument("testzip", help="path to the test zip")
+    parser.add_argument(
+        "reference", nargs="?", help="folder holding a reference solution"
+    )
+    parser.add_argument(
+        "--runner",
+        choices=RUNNERS,
+        default=DEFAULT_RUNNER,
+        help="how programs are started (default: {:s})".format(DEFAULT_RUNNER),
+    )
+    args = parser.parse_args(argv)
+    return calibrate(
+        args.testzip, args.reference, options=GraderOptions(runner=args.runner)
+    )
+
+
+def main_bench(argv):
+    parser = argparse.ArgumentParser(
+        prog="grader.py bench",
+        description="Time the grader on every test zip in graderzips/ against "
+        + "the reference solution in the folder of the same name.",
+    )
+    parser.add_argument(
+        "root",
+        nargs="?",
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help="folder holding graderzips/ and the solutions (default: the grader's folder)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of test cases to run at once (default: 1)",
+    )
+    parser.add_argument(
+        "--runner",
+        choices=RUNNERS,
+        default=DEFAULT_RUNNER,
+        help="how programs are started (default: {:s})".format(DEFAULT_RUNNER),
+    )
+    parser.add_argument(
+        "--save", metavar="FILE", help="write the timings to FILE as a baseline"
+    )
+    parser.add_argument(
+        "--compare", metavar="FILE", help="compare the timings to a saved baseline"
+    )
+    args = parser.parse_args(argv)
+    return bench(
+        args.root,
+        options=GraderOptions(jobs=args.jobs, runner=args.runner),
+        save=args.save,
+        compare=args.compare,
+    )
+
+
 def main():
-    if len(sys.argv) < 2:
+    commands = {"batch": main_batch, "calibrate": main_calibrate, "bench": main_bench}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description="Grade programs against a test zip.")
+    parser.add_argument("testzip", nargs="?", help="path to the test zip")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, and grade a program again whenever its source changes",
+    )
+    _add_options(parser)
+    args = parser.parse_args()
+    options = _get_options(args)
+    if args.testzip is None and (args.jsonl or args.junit):
+        parser.error("--jsonl and --junit need a test zip")
+    if args.watch:
+        if args.testzip is None:
+            parser.error("--watch needs a test zip")
+        if args.jsonl or args.junit:
+            parser.error("--jsonl and --junit can't be used with --watch")
+        return watch(args.testzip, options=options)
+
+    if args.testzip is None:
         zips = glob.glob("tests-lab*.zip")
         testzip, latest = None, -1
         for z in zips:
@@ -1125,9 +4096,10 @@ def main():
             )
         if testzip is not None:
             print("Selected {zippath:s} by default...".format(zippath=testzip))
-        return test_via_gui(testzip)
+        return test_via_gui(testzip, options=options)
     else:
-        return test_via_console(sys.argv[1])
+        with ResultWriter(jsonl=args.jsonl, junit=args.junit) as writer:
+            return test_via_console(args.testzip, options=options, writer=writer)
 
 
 if __name__ == "__main__":